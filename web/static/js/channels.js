@@ -1,6 +1,16 @@
+const OPCODE_INPUT = 0x00
+const OPCODE_OUTPUT = 0x01
+// Opcode followed by the big-endian u64 stream offset the output ends at
+const OUTPUT_HEADER_SIZE = 9
+const RECONNECT_DELAY_MIN = 1000
+const RECONNECT_DELAY_MAX = 30000
+
 class WebSocketManager {
     constructor(url, terminal = null, editor = null) {
+        this.url = url
+        this.reconnectDelay = RECONNECT_DELAY_MIN
         this.websocket = new WebSocket(url)
+        this.websocket.binaryType = 'arraybuffer'
 
         if (terminal) {
             this.terminal = terminal
@@ -11,19 +21,45 @@ class WebSocketManager {
         }
     }
 
+    reconnectTerminal() {
+        // Resume from the last output offset written, the server replays only what was missed.
+        const separator = this.url.includes('?') ? '&' : '?'
+        const offset = this.terminal.resyncing ? null : this.terminal.outputOffset
+        const url = offset === null ? this.url : `${this.url}${separator}offset=${offset}`
+
+        this.websocket = new WebSocket(url)
+        this.websocket.binaryType = 'arraybuffer'
+        this.setupTerminalLogic()
+    }
+
     setupTerminalLogic() {
         this.websocket.onerror = (e) => {
             this.terminal.writeMessage('WebSocket connection error\n\r')
         };
 
         this.websocket.onopen = () => {
+            this.reconnectDelay = RECONNECT_DELAY_MIN
             if (this.terminal) {
                 this.terminal.setWebSocket(this.websocket);
                 this.terminal.performResize()
             }
         };
 
+        this.websocket.onclose = () => {
+            setTimeout(() => this.reconnectTerminal(), this.reconnectDelay)
+            this.reconnectDelay = Math.min(this.reconnectDelay * 2, RECONNECT_DELAY_MAX)
+        };
+
         this.websocket.onmessage = (e) => {
+            if (e.data instanceof ArrayBuffer) {
+                const view = new DataView(e.data)
+                if (view.getUint8(0) === OPCODE_OUTPUT && !this.terminal.resyncing) {
+                    this.terminal.writeOutput(new Uint8Array(e.data, OUTPUT_HEADER_SIZE),
+                        Number(view.getBigUint64(1)))
+                }
+                return
+            }
+
             let data = JSON.parse(e.data);
 
             if (data.message) {
@@ -32,7 +68,9 @@ class WebSocketManager {
                         this.terminal.writeMessage(data.message.content + '\n\r')
                         break
                     case 'info':
-                        this.terminal.writeMessage(data.message.content);
+                        if (!this.terminal.resyncing) {
+                            this.terminal.writeOutput(data.message.content, data.message.offset);
+                        }
                         break
                     case 'action':
                         if (data.message.content.type === 'require_reconnect') {
@@ -44,8 +82,17 @@ class WebSocketManager {
                                 window.parent.removeElementsForSession(data.message.content.session_id)
                             }
                         } else if (data.message.content.type === 'load_content' && this.terminal.termContentLoadedFromDb === false) {
-                            this.terminal.writeMessage(data.message.content.data)
+                            this.terminal.loadContent(data.message.content.data, data.message.content.offset,
+                                data.message.content.end)
                             this.terminal.termContentLoadedFromDb = true
+                            this.terminal.resyncing = false
+                        } else if (data.message.content.type === 'latency_probe') {
+                            this.terminal.reportLatency(data.message.content.id)
+                        } else if (data.message.content.type === 'resync') {
+                            this.terminal.resync()
+                        } else if (data.message.content.type === 'scrollback') {
+                            this.terminal.prependScrollback(data.message.content.data, data.message.content.offset,
+                                data.message.content.before_offset)
                         }
                 }
             }
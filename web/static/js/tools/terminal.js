@@ -1,14 +1,39 @@
+const SCROLLBACK_PAGE_BYTES = 65536
+const SCROLLBACK_HISTORY_MAX = 2 * 1024 * 1024
+// Lines xterm keeps above the viewport, enough for SCROLLBACK_HISTORY_MAX of ordinary output
+const SCROLLBACK_LINES = 50000
+const INPUT_BATCH_WINDOW = 5
+
 class TerminalManager {
     constructor() {
         this.term = null
         this.fitAddon = null
         this.termContentLoadedFromDb = false
+        this.resyncing = false
         this.socket = null
+        this.encoder = new TextEncoder()
+        this.pendingInput = ''
+        this.inputTimer = null
+        // When the current input batch was typed and sent, and when the first output after it arrived
+        this.inputTypedAt = null
+        this.inputSentAt = null
+        this.echoAt = null
+        // Stream offset of the last output written, sent back when the WebSocket reconnects
+        this.outputOffset = null
+
+        // Everything written since load_content, replayed after older scrollback is put in front of it
+        this.history = []
+        this.historySize = 0
+        this.historyOffset = null
+        this.fetchingScrollback = false
+        // Set once prepended output no longer fits in xterm's scrollback, nothing older is fetched then
+        this.scrollbackFull = false
     }
 
     createTerminal() {
         let termOptions = {
             cursorBlink: true,
+            scrollback: SCROLLBACK_LINES,
             theme: {
                 background: 'black',
                 foreground: 'white',
@@ -31,25 +56,155 @@ class TerminalManager {
             this.fitAddon.fit();
             this.term.focus()
             this.setupResizeListener();
+            this.setupScrollbackListener(container);
         }
     }
 
     setWebSocket(socket) {
+        const attached = this.socket !== null
         this.socket = socket;
 
-        if (this.term) {
+        if (this.term && !attached) {
             this.term.onData(data => {
-                this.sendData(JSON.stringify({'action': 'execute', 'data': data}));
+                this.sendInput(data);
             });
         }
     }
 
+    sendInput(data) {
+        // The first keystroke goes out at once, keystrokes typed within the next INPUT_BATCH_WINDOW ms
+        // (fast typing, key repeat) are sent together in one frame.
+        if (!this.pendingInput) {
+            this.inputTypedAt = performance.now()
+        }
+        this.pendingInput += data
+        if (this.inputTimer === null) {
+            this.flushInput()
+        }
+    }
+
+    flushInput() {
+        this.inputTimer = null
+        if (!this.pendingInput || this.socket.readyState !== WebSocket.OPEN) {
+            return
+        }
+
+        const encoded = this.encoder.encode(this.pendingInput);
+        this.pendingInput = ''
+        const frame = new Uint8Array(encoded.length + 1);
+        frame[0] = OPCODE_INPUT;
+        frame.set(encoded, 1);
+        this.socket.send(frame);
+        this.inputSentAt = performance.now()
+        this.echoAt = null
+        this.inputTimer = setTimeout(() => this.flushInput(), INPUT_BATCH_WINDOW)
+    }
+
     sendData(data_json) {
+        if (this.socket.readyState !== WebSocket.OPEN) {
+            return
+        }
         this.socket.send(data_json);
     }
 
     writeMessage(message) {
         this.term.write(message)
+
+        if (this.historyOffset !== null) {
+            this.history.push(message)
+            this.historySize += message.length
+            if (this.historySize > SCROLLBACK_HISTORY_MAX) {
+                this.history = []
+                this.historySize = 0
+                this.historyOffset = null
+            }
+        }
+    }
+
+    writeOutput(data, offset) {
+        if (this.echoAt === null && this.inputSentAt !== null) {
+            this.echoAt = performance.now()
+        }
+        this.writeMessage(data)
+        if (offset !== undefined) {
+            this.outputOffset = offset
+        }
+    }
+
+    reportLatency(id) {
+        // The server traced the last input batch, answer with the time the browser batched it
+        // and the time from sending it to the first output that came back.
+        if (this.echoAt === null) {
+            return
+        }
+        this.sendData(JSON.stringify({'action': 'latency', 'data': {
+            'id': id, 'batch': this.inputSentAt - this.inputTypedAt, 'round_trip': this.echoAt - this.inputSentAt}}))
+    }
+
+    loadContent(data, offset, end) {
+        this.outputOffset = end === undefined ? null : end
+        this.history = []
+        this.historySize = 0
+        this.historyOffset = null
+        this.scrollbackFull = false
+        this.writeMessage(data)
+        this.historyOffset = offset === undefined ? null : offset
+        if (this.historyOffset !== null) {
+            this.history = [data]
+            this.historySize = data.length
+        }
+    }
+
+    setupScrollbackListener(container) {
+        container.addEventListener('wheel', (e) => {
+            if (e.deltaY < 0 && this.term.buffer.active.viewportY === 0) {
+                this.fetchScrollback()
+            }
+        });
+    }
+
+    fetchScrollback() {
+        if (this.fetchingScrollback || this.scrollbackFull || !this.historyOffset ||
+            this.historySize >= SCROLLBACK_HISTORY_MAX) {
+            return
+        }
+
+        // Every page is as large as the history already loaded, each one replays the whole history
+        // so this keeps the total work proportional to its size.
+        const limit = Math.min(Math.max(SCROLLBACK_PAGE_BYTES, this.historySize), SCROLLBACK_HISTORY_MAX - this.historySize)
+        this.fetchingScrollback = true
+        this.sendData(JSON.stringify({'action': 'fetch_scrollback',
+            'data': {'before_offset': this.historyOffset, 'limit': limit}}));
+    }
+
+    prependScrollback(data, offset, beforeOffset) {
+        this.fetchingScrollback = false
+        if (beforeOffset !== this.historyOffset) {
+            return
+        }
+
+        this.term.reset()
+        this.term.write(data)
+        this.history.forEach((chunk) => this.term.write(chunk))
+        this.term.write('', () => {
+            // A full buffer trimmed its oldest lines, the page just put in front is (partly) gone.
+            const buffer = this.term.buffer.active
+            this.scrollbackFull = buffer.length >= SCROLLBACK_LINES + this.term.rows
+            this.term.scrollToTop()
+        })
+
+        this.history.unshift(data)
+        this.historySize += data.length
+        this.historyOffset = offset
+    }
+
+    resync() {
+        // The server dropped output this viewer could not keep up with, reload the scrollback.
+        this.resyncing = true
+        this.termContentLoadedFromDb = false
+        this.scrollbackFull = false
+        this.term.reset()
+        this.sendData(JSON.stringify({'action': 'load_content'}));
     }
 
     setupResizeListener() {
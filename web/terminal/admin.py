@@ -71,7 +71,7 @@ class NotesDataAdmin(BaseDataAdmin):
     ...
 
 class SSHDataAdmin(BaseDataAdmin):
-    ...
+    readonly_fields = BaseDataAdmin.readonly_fields + ('transcript_size', 'transcript_chunks')
 
 
 admin.site.register(NotesData, NotesDataAdmin)
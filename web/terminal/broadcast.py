@@ -0,0 +1,188 @@
+import asyncio
+import json
+import struct
+from collections import deque
+from web.settings import OUTPUT_COALESCE_WINDOW, OUTPUT_COALESCE_MAX_BYTES, VIEWER_OVERFLOW_POLICY, \
+    VIEWER_QUEUE_MAX_MESSAGES, VIEWER_QUEUE_MAX_BYTES
+
+# Binary frames carry raw PTY bytes prefixed with a one-byte opcode (output frames also with
+# the big-endian u64 stream offset they end at), control messages (resize, reconnect,
+# load_content...) stay on text frames.
+OPCODE_INPUT = 0x00
+OPCODE_OUTPUT = 0x01
+OUTPUT_HEADER = struct.Struct('>BQ')
+
+
+def output_frame(data, offset) -> bytes:
+    return OUTPUT_HEADER.pack(OPCODE_OUTPUT, offset) + data
+
+
+def frame_payload(frame) -> bytes:
+    return frame[OUTPUT_HEADER.size:]
+
+
+def message_frame(message) -> str:
+    return json.dumps({'message': message})
+
+
+class OutputCoalescer:
+    ''' Merges terminal output chunks into fewer group broadcasts.
+
+    A chunk arriving after an idle window is published right away (interactive echo),
+    anything that follows within the window is buffered until either `max_bytes`
+    are pending or the window expires. Every chunk comes with the stream offset it ends at,
+    a batch is published with the offset of its last chunk.
+    '''
+
+    def __init__(self, publish, window=OUTPUT_COALESCE_WINDOW, max_bytes=OUTPUT_COALESCE_MAX_BYTES):
+        self.publish = publish
+        self.window = window
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.offset = None
+        self.last_flush = float('-inf')
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+    async def write(self, data, offset):
+        loop = asyncio.get_running_loop()
+
+        if not self.buffer and loop.time() - self.last_flush >= self.window:
+            await self.__publish(data, offset)
+            return
+
+        self.buffer += data
+        self.offset = offset
+
+        if len(self.buffer) >= self.max_bytes:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.buffer:
+            return
+
+        data, self.buffer = bytes(self.buffer), bytearray()
+        await self.__publish(data, self.offset)
+
+    async def __publish(self, data, offset):
+        # The lock is FIFO, so chunks reach the channel layer in the order they were read.
+        self.last_flush = asyncio.get_running_loop().time()
+        async with self.lock:
+            await self.publish(data, offset)
+
+
+class ViewerOutbox:
+    ''' Bounded queue of frames waiting to be written to one viewer's WebSocket.
+
+    Frames are `(kind, payload, offset)` triples: `output` carries a binary output frame and the stream
+    offset it ends at, `text` a ready JSON string, `snapshot` a JSON snapshot reflecting the output
+    up to its offset and `resync` tells the viewer to reload its scrollback. A writer task drains
+    the queue so a slow viewer never blocks the channel layer for the rest of the group.
+    When the queue grows past its limits the overflow policy decides what happens:
+
+    - coalesce: merge pending output into as few frames as possible, resync if still too big
+    - resync: drop pending output and queue a resync marker
+    - disconnect: report the overflow so the consumer closes the socket
+
+    Only terminal viewers (`resync=True`) can reload their scrollback. Whatever the policy, a queue
+    still over its limits afterwards (text and snapshots are never dropped) is reported as well.
+    '''
+    COALESCE, RESYNC, DISCONNECT = 'coalesce', 'resync', 'disconnect'
+
+    instances = {}
+
+    def __init__(self, name, write, group=None, resync=True, policy=VIEWER_OVERFLOW_POLICY,
+                 max_messages=VIEWER_QUEUE_MAX_MESSAGES, max_bytes=VIEWER_QUEUE_MAX_BYTES):
+        self.name = name
+        self.group = group
+        self.resync = resync
+        self.write = write
+        self.policy = policy
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.size = 0
+        self.overflows = 0
+        self.wakeup = asyncio.Event()
+        self.paused = False
+        self.task = None
+
+    def start(self):
+        self.instances[self.name] = self
+        self.task = asyncio.create_task(self.__run())
+
+    def stop(self):
+        self.instances.pop(self.name, None)
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def pause(self):
+        self.paused = True
+
+    def release(self, kind=None, payload=None, offset=None):
+        ''' Put a frame in front of everything queued so far and resume writing '''
+        if kind is not None:
+            self.queue.appendleft((kind, payload, offset))
+            self.size += len(payload) if payload else 0
+
+        self.paused = False
+        self.wakeup.set()
+
+    def put(self, kind, payload=None, offset=None) -> bool:
+        ''' Queue a frame, False means the viewer overflowed and has to be disconnected '''
+        self.queue.append((kind, payload, offset))
+        self.size += len(payload) if payload else 0
+        self.wakeup.set()
+
+        if self.__within_limits():
+            return True
+
+        self.overflows += 1
+
+        if self.policy == self.DISCONNECT:
+            return False
+        if self.policy == self.COALESCE:
+            self.__coalesce()
+        if self.resync and (self.policy == self.RESYNC or self.size > self.max_bytes):
+            self.__resync()
+        return self.__within_limits()
+
+    def __within_limits(self):
+        return len(self.queue) <= self.max_messages and self.size <= self.max_bytes
+
+    def __coalesce(self):
+        merged = deque()
+        for kind, payload, offset in self.queue:
+            if kind == 'output' and merged and merged[-1][0] == 'output':
+                merged[-1] = ('output', output_frame(frame_payload(merged[-1][1]) + frame_payload(payload), offset),
+                              offset)
+            else:
+                merged.append((kind, payload, offset))
+        self.queue = merged
+        # Every merge drops a frame header
+        self.size = sum(len(payload) for _, payload, _ in merged if payload)
+
+    def __resync(self):
+        kept = deque(frame for frame in self.queue if frame[0] in ('text', 'snapshot'))
+        kept.append(('resync', None, None))
+        self.queue = kept
+        self.size = sum(len(payload) for _, payload, _ in kept if payload)
+
+    async def __run(self):
+        while True:
+            while not self.queue or self.paused:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            kind, payload, offset = self.queue.popleft()
+            self.size -= len(payload) if payload else 0
+            await self.write(kind, payload, offset)
+
+    def stats(self):
+        return {'name': self.name, 'group': self.group, 'messages': len(self.queue), 'bytes': self.size, 'overflows': self.overflows}
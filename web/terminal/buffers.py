@@ -0,0 +1,91 @@
+import asyncio
+from web.settings import OUTPUT_RING_BUFFER_BYTES
+
+
+class RingBuffer:
+    ''' Fixed capacity ring holding the most recent raw output of one SSH session.
+
+    Bytes are addressed by stream offset, their position in everything the session printed (the same
+    position the transcript store uses). `flushed` marks how far the output reached the transcript,
+    the bytes after it are flushed from here and older ones stay around for viewers resuming a dropped
+    socket. Reads hand out `memoryview` slices of the ring, copied once by whoever keeps the bytes.
+    A flush peeks at the pending bytes and commits them once they are stored, under `flush_lock`.
+    '''
+    instances = {}
+
+    def __init__(self, start=0, capacity=OUTPUT_RING_BUFFER_BYTES):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = start
+        self.end = start
+        self.flushed = start
+        self.flush_lock = asyncio.Lock()
+
+    @classmethod
+    def create(cls, session_id, start=0):
+        cls.instances[session_id] = cls(start)
+        return cls.instances[session_id]
+
+    @classmethod
+    def get(cls, session_id):
+        return cls.instances.get(session_id)
+
+    @classmethod
+    def discard(cls, session_id):
+        cls.instances.pop(session_id, None)
+
+    @property
+    def pending(self):
+        return self.end - self.flushed
+
+    def append(self, data) -> int:
+        ''' Store a chunk and return the stream offset it ends at '''
+        end = self.end + len(data)
+        data = memoryview(data)[-self.capacity:]
+
+        position = (end - len(data)) % self.capacity
+        first = min(len(data), self.capacity - position)
+        self.view[position:position + first] = data[:first]
+        self.view[:len(data) - first] = data[first:]
+
+        self.end = end
+        self.start = max(self.start, end - self.capacity)
+        return end
+
+    def slices(self, start, end):
+        ''' Zero-copy views of the output between two offsets, two of them when it wraps around '''
+        length = end - start
+        position = start % self.capacity
+        first = min(length, self.capacity - position)
+        views = [self.view[position:position + first]]
+        if length > first:
+            views.append(self.view[:length - first])
+        return views
+
+    def since(self, offset):
+        ''' Output after `offset`, None when it is no longer (or not yet) in the buffer '''
+        if not self.start <= offset <= self.end:
+            return None
+        return b''.join(self.slices(offset, self.end))
+
+    def peek_pending(self):
+        ''' Output not flushed to the transcript yet and the offset it ends at, to be passed to `commit` '''
+        return b''.join(self.slices(self.flushed, self.end)), self.end
+
+    def commit(self, offset):
+        ''' Mark the output up to `offset` as flushed '''
+        self.flushed = max(self.flushed, offset)
+
+    def stats(self):
+        return {'capacity': self.capacity, 'used': self.end - self.start, 'pending': self.pending}
+
+    @classmethod
+    def memory_stats(cls):
+        buffers = list(cls.instances.values())
+        return {
+            'sessions': len(buffers),
+            'allocated': sum(buffer.capacity for buffer in buffers),
+            'used': sum(buffer.end - buffer.start for buffer in buffers),
+            'pending': sum(buffer.pending for buffer in buffers),
+        }
@@ -1,21 +1,49 @@
 import asyncio
+import codecs
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.core.exceptions import ObjectDoesNotExist
 from terminal.models import SessionsList, BaseData
 from channels.db import database_sync_to_async
 from asgiref.sync import sync_to_async
-from terminal.errors import ReconnectRequired
+from terminal.broadcast import ViewerOutbox, OPCODE_INPUT, output_frame, frame_payload, message_frame
+from terminal.gateway import send_to_gateway
+from terminal.metrics import Metrics
+from terminal.search import NoteIndexer
+from terminal.tracing import LatencyTracer
+from web.settings import SSH_GATEWAY_SYNC_TIMEOUT
 
 class SessionCosumer(AsyncWebsocketConsumer):
+    CLOSE_SLOW_CONSUMER = 4008
+
+    # Consumers of this process in each session group
+    viewers = {}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session_id = None
         self.ssh_session_id = None
-        self.read_task = None
+        self.binary = False
+        self.decoder = None
+        self.outbox = None
+        self.resume_offset = None
+        self.sent_offset = None
+        self.sync_timeout = None
+        # (SessionsList, data object) resolved once, dropped by `session_invalidate` when either changes
+        self.context = None
+        # Sampled input whose echo is on its way to this viewer, and the one the browser is asked to time
+        self.trace = None
+        self.probe = None
+
+    async def __get_session(self):
+        if self.context is None:
+            self.context = await self.__load_session()
+        return self.context
 
     @database_sync_to_async
-    def __get_session(self):
+    def __load_session(self):
         try:
             obj: SessionsList = SessionsList.objects.select_related('user', 'content_type').get(pk=self.session_id) # slave
             data_obj: BaseData = obj.content_object # master
@@ -26,40 +54,58 @@ class SessionCosumer(AsyncWebsocketConsumer):
 
     async def connect(self, *args, **kwargs):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.binary = query.get('mode') == ['binary']
+        self.resume_offset = self.__parse_offset(query.get('offset'))
         obj, data_obj = await self.__get_session()
         self.ssh_session_id = str(data_obj.id)
+        self.outbox = ViewerOutbox(self.channel_name, self.write_frame, group=self.ssh_session_id,
+                                   resync=obj is not None and obj.content_type.model == 'sshdata')
+        self.outbox.start()
         await self.channel_layer.group_add(self.ssh_session_id, self.channel_name)
+        self.viewers[self.ssh_session_id] = self.viewers.get(self.ssh_session_id, 0) + 1
         await self.accept()
 
         if obj is None or data_obj is None:
             return
 
         if obj.content_type.model == 'sshdata':
-            await self.send_group_message(msg_type='action', message={'type': 'load_content',
-                                                                                'data': await data_obj.get_content()})
-            try:
-                await data_obj.connect()
-            except ReconnectRequired as e:
-                await self.send_group_message(e)
-                await self.send_group_message(msg_type='action', message={'type': 'require_reconnect',
-                                                                                'session_saved': e.session_saved})
-            except Exception as e:
-                await self.send_group_message(e)
-
-            self.start_read()
+            # Nothing is written until the gateway's snapshot or replay, see `gateway_sync`.
+            self.outbox.pause()
+            self.sync_timeout = asyncio.get_running_loop().call_later(SSH_GATEWAY_SYNC_TIMEOUT, self.__sync_timed_out)
+            await send_to_gateway({'type': 'ssh.open', 'session': data_obj.id, 'reply_to': self.channel_name,
+                                   'offset': self.resume_offset})
 
         elif obj.content_type.model == 'notesdata':
             data = await sync_to_async(lambda: data_obj.get_content())()
             await self.send_group_message(msg_type='action', myself=True, message={'type': 'load_content', 'delta': data})
 
+    @staticmethod
+    def __parse_offset(value):
+        try:
+            offset = int(value[0])
+        except (TypeError, ValueError):
+            return None
+        return offset if offset >= 0 else None
+
     async def disconnect(self, code):
+        if self.sync_timeout is not None:
+            self.sync_timeout.cancel()
+        if self.outbox is not None:
+            self.outbox.stop()
+        if self.ssh_session_id is not None:
+            await self.channel_layer.group_discard(self.ssh_session_id, self.channel_name)
+            self.viewers[self.ssh_session_id] -= 1
+            if not self.viewers[self.ssh_session_id]:
+                del self.viewers[self.ssh_session_id]
+
         obj, data_obj = await self.__get_session()
 
         if obj is None or data_obj is None:
             return
 
         if obj.content_type.model == 'sshdata':
-            await data_obj.disconnect()
+            await send_to_gateway({'type': 'ssh.close', 'session': data_obj.id, 'viewer': self.channel_name})
 
     async def send_group_message(self, message, exclusive=False, myself=False, msg_type=None):
         if msg_type is not None:
@@ -69,33 +115,141 @@ class SessionCosumer(AsyncWebsocketConsumer):
         else:
             message = {'type': 'info', 'content': message}
 
-        await self.channel_layer.group_send(
-            self.ssh_session_id,
-            {
-                'type': 'group_message',
-                'message': message,
-                'to_myself': myself,
-                'exclusive': exclusive,
-                'sender_channel_name': self.channel_name
-            }
-        )
+        with Metrics.timer('webterminal_channel_layer_send_seconds', event='group_message'):
+            await self.channel_layer.group_send(
+                self.ssh_session_id,
+                {
+                    'type': 'group_message',
+                    'frame': message_frame(message),
+                    'to_myself': myself,
+                    'exclusive': exclusive,
+                    'sender_channel_name': self.channel_name
+                }
+            )
+
+    async def session_invalidate(self, event):
+        self.context = None
 
     async def group_message(self, event):
         if event.get('to_myself') is True and event.get('sender_channel_name') == self.channel_name and \
                 event.get('sender_channel_name') is not None:
-            await self.send(text_data=json.dumps({'message': event['message']}))
+            await self.enqueue('text', event['frame'])
             return
 
         elif event.get('exclusive') is True:
             if event.get('sender_channel_name') != self.channel_name and event.get('sender_channel_name') is not None:
-                await self.send(text_data=json.dumps({'message': event['message']}))
+                await self.enqueue('text', event['frame'])
                 return
             else:
                 return
 
-        await self.send(text_data=json.dumps({'message': event['message']}))
+        await self.enqueue('text', event['frame'])
+
+    async def gateway_sync(self, event):
+        # The snapshot or replay goes in front of the output queued since the viewer joined,
+        # the part of that output it already covers is trimmed by `write_frame`.
+        if self.sync_timeout is not None:
+            self.sync_timeout.cancel()
+            self.sync_timeout = None
+
+        match event['kind']:
+            case 'snapshot':
+                content = {'type': 'load_content', 'data': event['data'], 'offset': event['offset'],
+                           'end': event['end']}
+                self.outbox.release('snapshot', message_frame({'type': 'action', 'content': content}), event['end'])
+
+            case 'replay':
+                self.sent_offset = event['offset']
+                if event['data']:
+                    self.outbox.release('output', output_frame(event['data'], event['end']), event['end'])
+                else:
+                    self.outbox.release()
+
+            case 'resync':
+                self.outbox.release('resync')
+
+            case 'error':
+                self.outbox.release('text', message_frame({'type': 'error', 'content': event['content']}))
+
+    def __sync_timed_out(self):
+        # No gateway answered, the client asks for a snapshot again once it gets the resync.
+        self.sync_timeout = None
+        if self.outbox.paused:
+            self.outbox.release('resync')
+            self.outbox.release('text', message_frame({'type': 'error', 'content': 'The SSH gateway did not answer'}))
+
+    async def group_output(self, event):
+        trace = event.get('trace')
+        if trace is not None and trace['viewer'] == self.channel_name:
+            trace['delivered'] = time.time()
+            trace['offset'] = event['offset']
+            self.trace = trace
+
+        await self.enqueue('output', event['frame'], event['offset'])
+
+    async def enqueue(self, kind, payload=None, offset=None):
+        if not self.outbox.put(kind, payload, offset):
+            self.outbox.stop()
+            await self.close(code=self.CLOSE_SLOW_CONSUMER)
+
+    async def write_frame(self, kind, payload, offset=None):
+        if kind == 'output':
+            payload = self.__unsent(payload, offset)
+            if payload is None:
+                return
+
+        match kind:
+            case 'text':
+                await self.send(text_data=payload)
+
+            case 'snapshot':
+                self.sent_offset = offset
+                await self.send(text_data=payload)
+
+            case 'resync':
+                self.decoder = None
+                await self.send(text_data=message_frame({'type': 'action', 'content': {'type': 'resync'}}))
+
+            case 'output' if self.binary:
+                await self.send(bytes_data=payload)
+
+            case 'output':
+                if self.decoder is None:
+                    self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+                content = self.decoder.decode(frame_payload(payload))
+                if content:
+                    await self.send(text_data=message_frame({'type': 'info', 'content': content, 'offset': offset}))
+
+        if kind == 'output' and self.trace is not None and offset >= self.trace['offset']:
+            await self.__finish_trace()
+
+    async def __finish_trace(self):
+        trace, self.trace = self.trace, None
+        trace['sent'] = time.time()
+        self.probe = trace['id'], LatencyTracer.record(trace)
+        await self.send(text_data=message_frame({'type': 'action', 'content': {'type': 'latency_probe',
+                                                                               'id': trace['id']}}))
+
+    def __unsent(self, frame, offset):
+        # Drop the part of a live frame this viewer already got through a snapshot or a replay,
+        # the frame shared by the group is only rebuilt when it has to be trimmed.
+        if self.sent_offset is not None:
+            payload = frame_payload(frame)
+            seen = self.sent_offset - (offset - len(payload))
+            if seen >= len(payload):
+                frame = None
+            elif seen > 0:
+                frame = output_frame(payload[seen:], offset)
+
+        self.sent_offset = offset if self.sent_offset is None else max(self.sent_offset, offset)
+        return frame
 
     async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receive_bytes(bytes_data)
+            return
+
         message = json.loads(text_data)
         obj, data_obj = await self.__get_session()
 
@@ -106,13 +260,11 @@ class SessionCosumer(AsyncWebsocketConsumer):
             match message.get('action'):
                 case 'execute':
                     data = message.get('data')
+                    if isinstance(data, list):
+                        data = ''.join(data)
                     if data:
-
-                        try:
-                            await data_obj.send(data)
-                        except Exception as e:
-                            await self.send_group_message(e)
-                        self.start_read()
+                        await send_to_gateway({'type': 'ssh.input', 'session': data_obj.id, 'data': data,
+                                               'trace': LatencyTracer.sample(self.channel_name)})
 
                 case 'reconnect':
                     if message.get('type') == 'form':
@@ -128,27 +280,36 @@ class SessionCosumer(AsyncWebsocketConsumer):
                             )
                         )()
 
+                    await send_to_gateway({'type': 'ssh.reconnect', 'session': data_obj.id})
+
+                case 'load_content':
+                    await send_to_gateway({'type': 'ssh.snapshot', 'session': data_obj.id,
+                                           'reply_to': self.channel_name})
+
+                case 'fetch_scrollback':
                     try:
-                        await data_obj.connect()
-                    except ReconnectRequired as e:
-                        await self.send_group_message(e)
-                        await self.send_group_message(msg_type='action', message={'type': 'require_reconnect',
-                                                                                  'session_saved': e.session_saved})
-                    except Exception as e:
-                        await self.send_group_message(e)
+                        before_offset = int(message['data']['before_offset'])
+                        limit = int(message['data']['limit'])
+                    except (KeyError, TypeError, ValueError, AttributeError):
+                        return
+                    if before_offset <= 0 or limit <= 0:
+                        return
 
-                    await self.send_group_message(msg_type='action', message={'type': 'reconnect_successful'})
-                    self.start_read()
+                    data, offset = await data_obj.get_scrollback(before_offset, limit)
+                    content = {'type': 'scrollback', 'data': data, 'offset': offset, 'before_offset': before_offset}
+                    await self.enqueue('text', message_frame({'type': 'action', 'content': content}))
 
                 case 'resize':
-                    if message.get('type') == 'del':
-                        size = message.get('data')
-                        await data_obj.del_terminal_size(size.get('cols'), size.get('rows'))
+                    size = message.get('data')
+                    await send_to_gateway({'type': 'ssh.resize', 'session': data_obj.id, 'viewer': self.channel_name,
+                                           'action': message.get('type'), 'cols': size.get('cols'),
+                                           'rows': size.get('rows')})
 
-                    elif message.get('type') == 'new':
-                        size = message.get('data')
-                        await data_obj.set_terminal_size(size.get('cols'), size.get('rows'))
-                        await data_obj.resize_terminal()
+                case 'latency':
+                    data = message.get('data') or {}
+                    if self.probe is not None and data.get('id') == self.probe[0]:
+                        LatencyTracer.record_client(self.probe[1], data.get('round_trip'), data.get('batch'))
+                        self.probe = None
 
         elif obj.content_type.model == 'notesdata':
             match message.get('action'):
@@ -179,33 +340,16 @@ class SessionCosumer(AsyncWebsocketConsumer):
                 case 'update_content':
                     data = message.get('data')
                     await sync_to_async(lambda: data_obj.set_content(data.get('delta')))()
+                    NoteIndexer.schedule(data_obj.id)
 
+    async def receive_bytes(self, bytes_data):
+        if len(bytes_data) < 2 or bytes_data[0] != OPCODE_INPUT:
+            return
 
+        obj, data_obj = await self.__get_session()
 
+        if obj is None or data_obj is None or obj.content_type.model != 'sshdata':
+            return
 
-
-    def start_read(self):
-        if self.read_task is None or self.read_task.done():
-            self.read_task = asyncio.create_task(self.read())
-
-    async def read(self):
-        no_data_duration = 0
-
-        while True:
-            if no_data_duration >= 30:
-                return
-
-            obj, data_obj = await self.__get_session()
-
-            if obj is None or data_obj is None:
-                return
-
-            if obj.content_type.model == 'sshdata':
-                data = await data_obj.read()
-            if data is not None:
-                no_data_duration = 0
-                await self.send_group_message(data)
-            else:
-                no_data_duration += 0.1
-
-            await asyncio.sleep(0.1)
+        await send_to_gateway({'type': 'ssh.input', 'session': data_obj.id, 'data': bytes_data[1:],
+                               'trace': LatencyTracer.sample(self.channel_name)})
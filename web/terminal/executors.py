@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from web.settings import SSH_CONNECT_WORKERS, SSH_DATA_WORKERS, SSH_KEEPALIVE_WORKERS, TERMINAL_SCREEN_WORKERS, \
+    TRANSCRIPT_WORKERS
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    ''' Bounded thread pool that keeps track of its queue depth, busy workers and queue wait time '''
+
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.perf_counter()
+        with self._stats_lock:
+            self.queued += 1
+
+        def run():
+            waited = time.perf_counter() - submitted_at
+            with self._stats_lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        return super().submit(run)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'name': self.name,
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+            }
+
+
+# Handshakes are slow and bursty, keep them away from the pool serving keystrokes of live sessions.
+connect_executor = InstrumentedExecutor('ssh-connect', SSH_CONNECT_WORKERS)
+data_executor = InstrumentedExecutor('ssh-data', SSH_DATA_WORKERS)
+# Keepalive replies of unresponsive peers hold a thread until the transport is given up.
+keepalive_executor = InstrumentedExecutor('ssh-keepalive', SSH_KEEPALIVE_WORKERS)
+# Output parsed into the server side screen models.
+screen_executor = InstrumentedExecutor('terminal-screen', TERMINAL_SCREEN_WORKERS)
+# Transcript compression and file writes.
+transcript_executor = InstrumentedExecutor('transcript', TRANSCRIPT_WORKERS)
+
+
+def executors_stats():
+    return [connect_executor.stats(), data_executor.stats(), keepalive_executor.stats(), screen_executor.stats(),
+            transcript_executor.stats()]
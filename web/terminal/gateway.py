@@ -0,0 +1,212 @@
+import asyncio
+from functools import partial
+from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from terminal.broadcast import OutputCoalescer, output_frame, message_frame
+from terminal.buffers import RingBuffer
+from terminal.errors import ReconnectRequired
+from terminal.metrics import Metrics
+from terminal.tracing import LatencyTracer
+from terminal.screen import TerminalScreen
+from terminal.ssh import SSHModule
+from web.settings import SSH_GATEWAY_CHANNEL, SSH_GATEWAY_SHARDS
+
+
+def gateway_channel(session_id):
+    return f'{SSH_GATEWAY_CHANNEL}-{int(session_id) % SSH_GATEWAY_SHARDS}'
+
+
+async def send_to_gateway(event):
+    ''' Hand an event to the gateway owning `event['session']`, handled in-process when no gateway is configured '''
+    if SSH_GATEWAY_CHANNEL is None:
+        await SSHGateway.handle(event)
+    else:
+        with Metrics.timer('webterminal_channel_layer_send_seconds', event='gateway'):
+            await get_channel_layer().send(gateway_channel(event['session']), event)
+
+
+class SSHGateway:
+    ''' The SSH side of every session: connections, output readers, ring buffers and screen models.
+
+    Viewers only send it events (`ssh.open`, `ssh.input`, `ssh.resize`, `ssh.snapshot`, `ssh.reconnect`,
+    `ssh.close`). Output and notices go back as group messages, snapshots and replays as a `gateway.sync`
+    reply to the viewer's channel, so the same code runs inside a web worker or in `runsshgateway`.
+    '''
+    locks = {}
+    waiting = {}
+
+    @classmethod
+    async def handle(cls, event):
+        handler = getattr(cls, event['type'].replace('.', '_'), None)
+        if handler is not None:
+            await handler(event)
+
+    @classmethod
+    async def handle_in_order(cls, event):
+        # Events of one session are handled one at a time in arrival order (the lock is FIFO),
+        # a slow handshake never holds up the other sessions of the process.
+        session_id = event['session']
+        lock = cls.locks.setdefault(session_id, asyncio.Lock())
+        cls.waiting[session_id] = cls.waiting.get(session_id, 0) + 1
+        try:
+            async with lock:
+                await cls.handle(event)
+        finally:
+            cls.waiting[session_id] -= 1
+            if not cls.waiting[session_id]:
+                del cls.waiting[session_id]
+                del cls.locks[session_id]
+
+    @staticmethod
+    @database_sync_to_async
+    def get_session(session_id):
+        from terminal.models import SSHData
+        return SSHData.objects.filter(pk=session_id).first()
+
+    @classmethod
+    async def ssh_open(cls, event):
+        data_obj = await cls.get_session(event['session'])
+        if data_obj is None:
+            # The viewer holds its output back until it hears from the gateway.
+            await cls.reply(event['reply_to'], kind='error', content='The session no longer exists')
+            return
+
+        if event.get('offset') is None:
+            await cls.reply_snapshot(data_obj, event['reply_to'])
+        else:
+            replay = await data_obj.get_output_since(event['offset'])
+            if replay is None:
+                await cls.reply(event['reply_to'], kind='resync')
+            else:
+                await cls.reply(event['reply_to'], kind='replay', data=replay[0], offset=event['offset'], end=replay[1])
+
+        await cls.connect(data_obj)
+        await cls.start_output(data_obj)
+
+    @classmethod
+    async def ssh_reconnect(cls, event):
+        data_obj = await cls.get_session(event['session'])
+        if data_obj is None:
+            return
+
+        # The viewers asking for it were counted when they opened the session.
+        await cls.connect(data_obj, join=False)
+        await cls.send_group_message(str(data_obj.id), {'type': 'action', 'content': {'type': 'reconnect_successful'}})
+        await cls.start_output(data_obj)
+
+    @classmethod
+    async def ssh_input(cls, event):
+        if event.get('trace') is not None:
+            LatencyTracer.begin(event['session'], event['trace'])
+        try:
+            await SSHModule.send(event['session'], event['data'])
+        except Exception as e:
+            await cls.send_group_message(str(event['session']), {'type': 'error', 'content': str(e)})
+
+    @classmethod
+    async def ssh_resize(cls, event):
+        data_obj = await cls.get_session(event['session'])
+        if data_obj is None:
+            return
+
+        if event['action'] == 'del':
+            await data_obj.del_terminal_size(event['viewer'])
+        elif event['action'] == 'new':
+            try:
+                cols, rows = int(event['cols']), int(event['rows'])
+            except (TypeError, ValueError):
+                return
+            await data_obj.set_terminal_size(event['viewer'], cols, rows)
+
+    @classmethod
+    async def ssh_snapshot(cls, event):
+        data_obj = await cls.get_session(event['session'])
+        if data_obj is not None:
+            await cls.reply_snapshot(data_obj, event['reply_to'])
+
+    @classmethod
+    async def ssh_close(cls, event):
+        session_id = event['session']
+        SSHModule.del_terminal_size(session_id, event['viewer'])
+
+        data_obj = await cls.get_session(session_id)
+        if data_obj is not None:
+            await data_obj.disconnect()
+            return
+
+        # The session row is already deleted, there is nothing left to flush the output to.
+        SSHModule.disconnect(session_id)
+        if session_id not in SSHModule.instances:
+            TerminalScreen.discard(session_id)
+            RingBuffer.discard(session_id)
+
+    @classmethod
+    async def connect(cls, data_obj, join=True):
+        group_name = str(data_obj.id)
+        try:
+            await data_obj.connect(join=join)
+        except ReconnectRequired as e:
+            await cls.send_group_message(group_name, {'type': 'error', 'content': str(e)})
+            await cls.send_group_message(group_name, {'type': 'action', 'content': {
+                'type': 'require_reconnect', 'session_saved': e.session_saved}})
+        except Exception as e:
+            await cls.send_group_message(group_name, {'type': 'error', 'content': str(e)})
+
+    @classmethod
+    async def start_output(cls, data_obj):
+        group_name = str(data_obj.id)
+        coalescer = OutputCoalescer(partial(cls.send_output, group_name))
+        session_saved = bool(await data_obj.get_save_session())
+
+        async def on_close():
+            await coalescer.flush()
+            await cls.send_group_message(group_name, {'type': 'action', 'content': {
+                'type': 'require_reconnect', 'session_saved': session_saved}})
+
+        await data_obj.start_output(coalescer.write, on_close)
+
+    @classmethod
+    async def reply_snapshot(cls, data_obj, reply_to):
+        data, offset, end = await data_obj.get_snapshot()
+        await cls.reply(reply_to, kind='snapshot', data=data, offset=offset, end=end)
+
+    @staticmethod
+    async def reply(reply_to, **content):
+        with Metrics.timer('webterminal_channel_layer_send_seconds', event='gateway_sync'):
+            await get_channel_layer().send(reply_to, {'type': 'gateway.sync', **content})
+
+    @staticmethod
+    async def send_output(group_name, data, offset):
+        event = {'type': 'group_output', 'frame': output_frame(data, offset), 'offset': offset}
+        trace = LatencyTracer.take(int(group_name))
+        if trace is not None:
+            event['trace'] = trace
+
+        with Metrics.timer('webterminal_channel_layer_send_seconds', event='group_output'):
+            await get_channel_layer().group_send(group_name, event)
+
+    @staticmethod
+    async def send_group_message(group_name, message):
+        with Metrics.timer('webterminal_channel_layer_send_seconds', event='group_message'):
+            await get_channel_layer().group_send(
+                group_name,
+                {
+                    'type': 'group_message',
+                    'frame': message_frame(message),
+                    'to_myself': False,
+                    'exclusive': False,
+                    'sender_channel_name': None
+                }
+            )
+
+
+class SSHGatewayConsumer(AsyncConsumer):
+    ''' Channel consumer of `runsshgateway`, every event becomes a task ordered per session '''
+    # The loop only keeps weak references to tasks
+    tasks = set()
+
+    async def dispatch(self, message):
+        task = asyncio.create_task(SSHGateway.handle_in_order(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
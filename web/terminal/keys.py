@@ -0,0 +1,71 @@
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives import serialization
+from terminal.errors import ReconnectRequired
+from web.settings import SSH_KEY_CACHE_TTL, SSH_KEY_WORKERS
+
+
+def decrypt_private_key(private_key: str, passphrase: str) -> str:
+    ''' Runs in a worker process: pays the KDF once and returns the key as unencrypted OpenSSH text '''
+    data = private_key.encode('utf-8')
+    password = passphrase.encode('utf-8')
+
+    if b'BEGIN OPENSSH PRIVATE KEY' in data:
+        key = serialization.load_ssh_private_key(data, password)
+    else:
+        key = serialization.load_pem_private_key(data, password)
+
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()
+    ).decode('utf-8')
+
+
+class KeyAgent:
+    ''' Parses every stored private key once and keeps the loaded key object in memory '''
+    cache = {}
+    executor = None
+
+    @staticmethod
+    def fingerprint(private_key, passphrase=None):
+        return hashlib.sha256(f'{private_key}\0{passphrase or ""}'.encode('utf-8')).hexdigest()
+
+    @classmethod
+    async def load(cls, private_key, passphrase, parse):
+        ''' Return the key parsed by `parse(unencrypted_text)`, decrypting it off the event loop on a cache miss '''
+        fingerprint = cls.fingerprint(private_key, passphrase)
+        entry = cls.cache.get(fingerprint)
+
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        text = private_key
+        if passphrase:
+            loop = asyncio.get_running_loop()
+            try:
+                text = await loop.run_in_executor(cls.__get_executor(), decrypt_private_key, private_key, passphrase)
+            except (ValueError, TypeError) as e:
+                raise ReconnectRequired(message=f'Unable to decrypt private key: {e}')
+
+        key = parse(text)
+        cls.cache[fingerprint] = (time.monotonic() + SSH_KEY_CACHE_TTL, key)
+        return key
+
+    @classmethod
+    def purge(cls, private_key=None, passphrase=None):
+        if private_key is None:
+            cls.cache.clear()
+        else:
+            cls.cache.pop(cls.fingerprint(private_key, passphrase), None)
+
+    @classmethod
+    def __get_executor(cls):
+        # Spawned workers do not inherit the server's threads and open sockets.
+        if cls.executor is None:
+            cls.executor = ProcessPoolExecutor(max_workers=SSH_KEY_WORKERS,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return cls.executor
@@ -0,0 +1,95 @@
+import asyncio
+from channels_redis.core import BoundedQueue, RedisChannelLayer
+
+
+class LocalFanoutChannelLayer(RedisChannelLayer):
+    ''' Redis channel layer delivering group messages to members in this process without a round trip.
+
+    Group members whose channel belongs to this process are also kept in `local_groups`, a group send
+    puts the message in their `local_queues` and only members on other processes are published to Redis.
+    Membership itself still lives in Redis so every process can reach every viewer.
+
+    `receive` waits on the local queue and on Redis at the same time. The Redis receive is never
+    cancelled for a local message (a cancelled BZPOPMIN can lose the message it popped), it is kept
+    in `remote_receives` and awaited again by the next `receive` of the channel.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_groups = {}
+        self.local_queues = {}
+        self.remote_receives = {}
+
+    def is_local(self, channel):
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    def local_queue(self, channel):
+        if channel not in self.local_queues:
+            self.local_queues[channel] = BoundedQueue(self.capacity)
+        return self.local_queues[channel]
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+
+        queue = self.local_queue(channel)
+        remote = self.remote_receives.get(channel)
+        if remote is not None and remote.done():
+            return self.remote_receives.pop(channel).result()
+        if not queue.empty():
+            return queue.get_nowait()
+
+        if remote is None:
+            remote = self.remote_receives[channel] = asyncio.ensure_future(super().receive(channel))
+        local = asyncio.ensure_future(queue.get())
+
+        try:
+            await asyncio.wait((remote, local), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # The consumer is going away, its Redis receive goes with it as it would without this layer.
+            local.cancel()
+            remote.cancel()
+            self.remote_receives.pop(channel, None)
+            self.local_queues.pop(channel, None)
+            raise
+
+        if local.done():
+            return local.result()
+
+        local.cancel()
+        return self.remote_receives.pop(channel).result()
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.local_groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+
+        if not any(channel in members for members in self.local_groups.values()):
+            self.local_queues.pop(channel, None)
+
+    async def group_send(self, group, message):
+        # Every receiver gets its own dict, as it would after a trip through Redis.
+        for channel in self.local_groups.get(group, ()):
+            self.local_queue(channel).put_nowait(dict(message))
+        await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Called by `group_send` with the members registered in Redis, the local ones were served above.
+        remote = [channel for channel in channel_names if not self.is_local(channel)]
+        return super()._map_channel_keys_to_connection(remote, message)
+
+    async def flush(self):
+        self.local_groups = {}
+        self.local_queues = {}
+        for remote in self.remote_receives.values():
+            remote.cancel()
+        self.remote_receives = {}
+        await super().flush()
@@ -0,0 +1,124 @@
+import asyncio
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+BACKENDS = (
+    'terminal.ssh_backends.ParamikoBackend',
+    'terminal.ssh_backends.AsyncSSHBackend',
+)
+
+
+class EchoServer(asyncssh.SSHServer if asyncssh else object):
+    ''' Accepts any password, the shell echoes every byte back like a PTY with echo on '''
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+
+async def echo_shell(process):
+    while True:
+        try:
+            data = await process.stdin.read(4096)
+        except asyncssh.TerminalSizeChanged:
+            # Backends resize the PTY while the shell runs, that is no reason to stop echoing.
+            continue
+        if not data:
+            break
+        process.stdout.write(data)
+    process.exit(0)
+
+
+class Command(BaseCommand):
+    help = 'Compare per-keystroke latency and sessions-per-core of the SSH backends against a local in-process server.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keystrokes', type=int, default=2000, help='Keystrokes used for the latency run.')
+        parser.add_argument('--sessions', type=int, default=50, help='Concurrent sessions for the load run.')
+        parser.add_argument('--rate', type=float, default=10.0, help='Keystrokes per second per session.')
+        parser.add_argument('--duration', type=float, default=10.0, help='Length of the load run in seconds.')
+        parser.add_argument('--backend', action='append', dest='backends', help='Backend dotted path (repeatable).')
+
+    def handle(self, *args, **options):
+        if asyncssh is None:
+            raise CommandError("The in-process SSH server requires the 'asyncssh' package.")
+
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        host_key = asyncssh.generate_private_key('ssh-ed25519')
+        server = await asyncssh.create_server(EchoServer, '127.0.0.1', 0, server_host_keys=[host_key],
+                                              process_factory=echo_shell, encoding=None)
+        port = server.sockets[0].getsockname()[1]
+
+        try:
+            for path in options['backends'] or BACKENDS:
+                backend = import_string(path)()
+                latencies = await self.measure_latency(backend, port, options['keystrokes'])
+                sessions_per_core = await self.measure_load(backend, port, options['sessions'],
+                                                            options['rate'], options['duration'])
+
+                latencies.sort()
+                self.stdout.write(self.style.SUCCESS(path))
+                self.stdout.write(f"  keystroke->echo  mean {statistics.mean(latencies) * 1000:.3f} ms"
+                                  f"  p50 {latencies[len(latencies) // 2] * 1000:.3f} ms"
+                                  f"  p99 {latencies[int(len(latencies) * 0.99)] * 1000:.3f} ms")
+                self.stdout.write(f"  sessions per core @ {options['rate']:g} keys/s  {sessions_per_core:.0f}")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    @staticmethod
+    async def open_session(backend, port):
+        connection = await backend.connect('127.0.0.1', 'bench', 'bench', port, None, None)
+        channel = await backend.open_channel(connection)
+        return connection, channel
+
+    @staticmethod
+    async def keystroke(backend, channel):
+        start = time.perf_counter()
+        await backend.send(channel, 'x')
+        await backend.recv(channel, 1024)
+        return time.perf_counter() - start
+
+    async def measure_latency(self, backend, port, keystrokes):
+        connection, channel = await self.open_session(backend, port)
+        try:
+            return [await self.keystroke(backend, channel) for _ in range(keystrokes)]
+        finally:
+            backend.close_channel(channel)
+            backend.close(connection)
+
+    async def measure_load(self, backend, port, sessions, rate, duration):
+        # Both ends run in this process, so the estimate is pessimistic for the backend alone.
+        opened = await asyncio.gather(*(self.open_session(backend, port) for _ in range(sessions)))
+
+        async def typist(channel):
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                await self.keystroke(backend, channel)
+                await asyncio.sleep(1 / rate)
+
+        try:
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            await asyncio.gather(*(typist(channel) for _, channel in opened))
+            cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+        finally:
+            for connection, channel in opened:
+                backend.close_channel(channel)
+                backend.close(connection)
+
+        return sessions * wall / cpu if cpu else float('inf')
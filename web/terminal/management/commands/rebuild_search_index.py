@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from terminal.models import SSHData, NotesData, SearchEntry
+from terminal.search import index_transcript, index_note
+from terminal.transcripts import transcript_store
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index from the stored transcripts and notes (new output is indexed as it is flushed).'
+
+    def handle(self, *args, **options):
+        SearchEntry.objects.all().delete()
+
+        for session_id in SSHData.objects.filter(transcript_size__gt=0).values_list('pk', flat=True).iterator():
+            offset = 0
+            for payload in transcript_store.iter_transcript(session_id):
+                index_transcript(session_id, offset, payload)
+                offset += len(payload)
+
+        for note_id, content in NotesData.objects.exclude(content=None).values_list('pk', 'content').iterator():
+            index_note(note_id, content)
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {SearchEntry.objects.count()} entries.'))
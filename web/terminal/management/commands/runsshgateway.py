@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from channels.layers import get_channel_layer
+from channels.routing import ChannelNameRouter
+from channels.worker import Worker
+from terminal.gateway import SSHGatewayConsumer, gateway_channel
+from web.settings import SSH_GATEWAY_CHANNEL, SSH_GATEWAY_SHARDS
+
+
+class Command(BaseCommand):
+    help = 'Run an SSH gateway: owns the SSH connections of its shard and serves web workers over the channel layer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=0, help='Shard served by this process (0..SSH_GATEWAY_SHARDS-1).')
+
+    def handle(self, *args, **options):
+        if SSH_GATEWAY_CHANNEL is None:
+            raise CommandError('Set SSH_GATEWAY_CHANNEL to run SSH connections outside the web workers.')
+
+        shard = options['shard']
+        if not 0 <= shard < SSH_GATEWAY_SHARDS:
+            raise CommandError(f'--shard must be between 0 and {SSH_GATEWAY_SHARDS - 1}.')
+
+        channel = gateway_channel(shard)
+        self.stdout.write(f'SSH gateway listening on {channel}')
+
+        worker = Worker(
+            application=ChannelNameRouter({channel: SSHGatewayConsumer.as_asgi()}),
+            channels=[channel],
+            channel_layer=get_channel_layer(),
+        )
+        worker.run()
@@ -0,0 +1,166 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    ''' Counters and histograms of this process, rendered in the Prometheus text format.
+
+    Updates are plain dict increments made on the event loop (no locks on the hot path), series are
+    keyed by `(name, labels)`. Gauges are not stored: `render` reads them from the registries that
+    own them (SSHModule, RingBuffer, ViewerOutbox, the executors) when the endpoint is scraped.
+    '''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    counters = defaultdict(float)
+    # (name, labels) -> one count per bucket, the overflow (+Inf) count and the sum of observations
+    histograms = {}
+
+    HELP = {
+        'webterminal_output_bytes_total': 'Bytes read from SSH channels',
+        'webterminal_input_bytes_total': 'Bytes written to SSH channels',
+        'webterminal_session_output_bytes_total': 'Bytes read from the SSH channel of a session',
+        'webterminal_session_input_bytes_total': 'Bytes written to the SSH channel of a session',
+        'webterminal_transcript_flushed_bytes_total': 'Output bytes flushed to transcripts',
+        'webterminal_transcript_flush_seconds': 'Time to flush pending output to the transcript',
+        'webterminal_channel_layer_send_seconds': 'Time spent in channel layer sends',
+        'webterminal_latency_seconds': 'Keystroke-to-echo latency of sampled inputs per stage',
+    }
+
+    @classmethod
+    def inc(cls, name, value=1, **labels):
+        cls.counters[name, tuple(labels.items())] += value
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        key = name, tuple(labels.items())
+        histogram = cls.histograms.get(key)
+        if histogram is None:
+            histogram = cls.histograms[key] = [0] * (len(cls.BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(cls.BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.perf_counter() - started, **labels)
+
+    @classmethod
+    def forget(cls, **labels):
+        ''' Drop the series carrying these labels, e.g. the per-session ones of a closed session '''
+        wanted = set(labels.items())
+        for series in (cls.counters, cls.histograms):
+            for key in [key for key in series if wanted <= set(key[1])]:
+                del series[key]
+
+    @classmethod
+    def render(cls) -> str:
+        lines = []
+        families = defaultdict(list)
+        for (name, labels), value in list(cls.counters.items()):
+            families[name].append((labels, value))
+        for name, samples in sorted(families.items()):
+            cls.__family(lines, name, 'counter', samples)
+
+        families = defaultdict(list)
+        for (name, labels), histogram in list(cls.histograms.items()):
+            families[name].append((labels, histogram))
+        for name, samples in sorted(families.items()):
+            cls.__histogram(lines, name, samples)
+
+        for name, kind, help_text, samples in cls.collect():
+            cls.__family(lines, name, kind, samples, help_text)
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def collect():
+        ''' Gauges and counters kept by other registries, as `(name, type, help, [(labels, value)])` '''
+        from terminal.buffers import RingBuffer
+        from terminal.broadcast import ViewerOutbox
+        from terminal.consumers import SessionCosumer
+        from terminal.executors import executors_stats
+        from terminal.ssh import SSHModule
+
+        executors = executors_stats()
+        outboxes = defaultdict(list)
+        for outbox in list(ViewerOutbox.instances.values()):
+            stats = outbox.stats()
+            outboxes[stats['group']].append(stats)
+        buffers = RingBuffer.memory_stats()
+
+        yield 'webterminal_ssh_transports', 'gauge', 'Authenticated SSH transports held by this process', \
+            [((), len(SSHModule.pool))]
+        yield 'webterminal_ssh_sessions', 'gauge', 'Sessions with an open SSH channel', \
+            [((), len(SSHModule.channels))]
+        yield 'webterminal_ssh_active_connections', 'gauge', 'Viewers attached to the SSH connection of a session', \
+            [((('session', group_name),), count) for group_name, count in list(SSHModule.active_connections.items())]
+        yield 'webterminal_group_consumers', 'gauge', 'WebSocket consumers of this process in a session group', \
+            [((('group', group_name),), count) for group_name, count in list(SessionCosumer.viewers.items())]
+
+        for field, name, kind, help_text in (
+                ('max_workers', 'webterminal_executor_max_workers', 'gauge', 'Threads of the executor'),
+                ('queued', 'webterminal_executor_queued', 'gauge', 'Calls waiting for an executor thread'),
+                ('active', 'webterminal_executor_active', 'gauge', 'Calls running on the executor'),
+                ('completed', 'webterminal_executor_completed_total', 'counter', 'Calls completed by the executor'),
+                ('wait_time_total', 'webterminal_executor_wait_seconds_total', 'counter',
+                 'Seconds calls waited for an executor thread'),
+                ('wait_time_max', 'webterminal_executor_wait_seconds_max', 'gauge',
+                 'Longest wait for an executor thread in seconds')):
+            yield name, kind, help_text, [((('executor', stats['name']),), stats[field]) for stats in executors]
+
+        # Per session, a single slow viewer shows up in the max next to the total of its group
+        for field, name, kind, help_text, aggregate in (
+                ('name', 'webterminal_viewer_outboxes', 'gauge', 'Viewers with a WebSocket outbox', len),
+                ('messages', 'webterminal_viewer_queued_messages', 'gauge', 'Frames waiting in viewer outboxes', sum),
+                ('messages', 'webterminal_viewer_queued_messages_max', 'gauge',
+                 'Frames waiting in the fullest viewer outbox', max),
+                ('bytes', 'webterminal_viewer_queued_bytes', 'gauge', 'Bytes waiting in viewer outboxes', sum),
+                ('bytes', 'webterminal_viewer_queued_bytes_max', 'gauge', 'Bytes waiting in the fullest viewer outbox',
+                 max),
+                ('overflows', 'webterminal_viewer_overflows_total', 'counter', 'Overflows of the open viewer outboxes',
+                 sum)):
+            yield name, kind, help_text, [((('session', group_name),), aggregate([stats[field] for stats in group]))
+                                          for group_name, group in outboxes.items()]
+
+        yield 'webterminal_ring_buffers', 'gauge', 'Output ring buffers', [((), buffers['sessions'])]
+        yield 'webterminal_ring_buffer_bytes', 'gauge', 'Memory of the output ring buffers', \
+            [((('state', state),), buffers[state]) for state in ('allocated', 'used', 'pending')]
+
+    @classmethod
+    def __family(cls, lines, name, kind, samples, help_text=None):
+        help_text = help_text or cls.HELP.get(name)
+        if help_text:
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{cls.__labels(labels)} {cls.__value(value)}')
+
+    @classmethod
+    def __histogram(cls, lines, name, samples):
+        if name in cls.HELP:
+            lines.append(f'# HELP {name} {cls.HELP[name]}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in samples:
+            cumulative = 0
+            for bound, count in zip(cls.BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{cls.__labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_count{cls.__labels(labels)} {cumulative}')
+            lines.append(f'{name}_sum{cls.__labels(labels)} {cls.__value(histogram[-1])}')
+
+    @staticmethod
+    def __labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def __value(value):
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,67 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_content_to_chunks(apps, schema_editor):
+    SSHData = apps.get_model('terminal', 'SSHData')
+    TranscriptChunk = apps.get_model('terminal', 'TranscriptChunk')
+
+    for ssh_data in SSHData.objects.exclude(content='').iterator():
+        payload = ssh_data.content.encode('utf-8')
+        TranscriptChunk.objects.create(session=ssh_data, seq=0, offset=0, payload=payload)
+        ssh_data.transcript_size = len(payload)
+        ssh_data.transcript_chunks = 1
+        ssh_data.save(update_fields=['transcript_size', 'transcript_chunks'])
+
+
+def move_chunks_to_content(apps, schema_editor):
+    SSHData = apps.get_model('terminal', 'SSHData')
+    TranscriptChunk = apps.get_model('terminal', 'TranscriptChunk')
+
+    for ssh_data in SSHData.objects.filter(transcript_chunks__gt=0).iterator():
+        chunks = TranscriptChunk.objects.filter(session=ssh_data).order_by('seq').values_list('payload', flat=True)
+        ssh_data.content = b''.join(bytes(payload) for payload in chunks).decode('utf-8', errors='replace')
+        ssh_data.save(update_fields=['content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0030_merge_20240116_0324'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sshdata',
+            name='transcript_chunks',
+            field=models.PositiveIntegerField(default=0, help_text='Number of stored transcript chunks'),
+        ),
+        migrations.AddField(
+            model_name='sshdata',
+            name='transcript_size',
+            field=models.PositiveBigIntegerField(default=0, help_text='Bytes of terminal output stored in transcript chunks'),
+        ),
+        migrations.CreateModel(
+            name='TranscriptChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField(help_text='Position of the chunk in the transcript')),
+                ('offset', models.PositiveBigIntegerField(help_text='Byte offset of the first byte of this chunk in the transcript')),
+                ('payload', models.BinaryField(help_text='Raw terminal output')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='The date and time when the chunk was stored.')),
+                ('session', models.ForeignKey(help_text='SSH session this output belongs to', on_delete=django.db.models.deletion.CASCADE, related_name='transcript', to='terminal.sshdata')),
+            ],
+            options={
+                'ordering': ['session', 'seq'],
+                'indexes': [models.Index(fields=['session', 'offset'], name='transcript_session_offset_idx')],
+                'unique_together': {('session', 'seq')},
+            },
+        ),
+        migrations.RunPython(move_content_to_chunks, move_chunks_to_content),
+        migrations.RemoveField(
+            model_name='sshdata',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE terminal_searchentry_fts USING fts5("
+    "text, content='terminal_searchentry', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER terminal_searchentry_ai AFTER INSERT ON terminal_searchentry BEGIN "
+    "INSERT INTO terminal_searchentry_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER terminal_searchentry_ad AFTER DELETE ON terminal_searchentry BEGIN "
+    "INSERT INTO terminal_searchentry_fts(terminal_searchentry_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER terminal_searchentry_au AFTER UPDATE ON terminal_searchentry BEGIN "
+    "INSERT INTO terminal_searchentry_fts(terminal_searchentry_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO terminal_searchentry_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS terminal_searchentry_au",
+    "DROP TRIGGER IF EXISTS terminal_searchentry_ad",
+    "DROP TRIGGER IF EXISTS terminal_searchentry_ai",
+    "DROP TABLE IF EXISTS terminal_searchentry_fts",
+]
+POSTGRES_FORWARD = [
+    "CREATE INDEX terminal_searchentry_text_gin ON terminal_searchentry USING GIN (to_tsvector('simple', text))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS terminal_searchentry_text_gin",
+]
+
+
+def run_statements(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0031_transcriptchunk_remove_sshdata_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('ssh', 'SSH transcript'), ('note', 'Note')], help_text='What the indexed text comes from', max_length=4)),
+                ('object_id', models.PositiveIntegerField(help_text='Primary key of the SSHData or NotesData the text comes from')),
+                ('offset', models.PositiveBigIntegerField(default=0, help_text='Transcript offset of the indexed output (0 for notes)')),
+                ('text', models.TextField(help_text='Indexed text, without ANSI escape sequences')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='The date and time when the text was indexed.')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'object_id'], name='search_kind_object_idx')],
+            },
+        ),
+        migrations.RunPython(
+            run_statements({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run_statements({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
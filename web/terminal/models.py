@@ -1,5 +1,8 @@
+import asyncio
+import logging
 from typing import Self
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from colorfield.fields import ColorField
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
@@ -8,16 +11,25 @@ from encrypted_model_fields.fields import EncryptedCharField
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from abc import ABCMeta, abstractmethod
 from django.urls import reverse
+from django.utils import timezone
 from terminal.ssh import SSHModule
+from terminal.screen import TerminalScreen
+from terminal.buffers import RingBuffer
+from terminal.metrics import Metrics
+from terminal.transcripts import transcript_store
+from terminal.search import index_transcript
 from django.core.cache import cache
 from asgiref.sync import sync_to_async
-from functools import wraps
+from functools import wraps, partial
 from terminal.errors import ReconnectRequired
 import secrets
-from web.settings import COLOR_PALETTE
+from web.settings import COLOR_PALETTE, TERMINAL_INITIAL_SYNC_BYTES, SCROLLBACK_PAGE_MAX_BYTES, \
+    TERMINAL_RESUME_MAX_BYTES
 from django.core.exceptions import ImproperlyConfigured
 from terminal.apps import TerminalConfig
 
+logger = logging.getLogger(__name__)
+
 def strip_object(data: dict):
     return  {k: str(v).strip() if v else None for k, v in data.items()}
 
@@ -248,21 +260,25 @@ class NotesData(BaseData):
         return self.content
 
     def set_content(self, delta):
+        # Not a save(): an edit changes nothing the viewers cache, so it must not fire `session_data_changed`.
         self.content = delta
-        self.save()
+        self.updated_at = timezone.now()
+        NotesData.objects.filter(pk=self.pk).update(content=delta, updated_at=self.updated_at)
 
 class SSHData(BaseData):
     CACHED_CREDENTIALS = False
     BUFFER_SIZE_LIMIT = 65536
+    # Seconds between flush attempts while the ring is full of output the transcript refuses
+    FLUSH_RETRY_DELAY = 1
     TERM_MIN_WIDTH, TERM_MIN_HEIGHT = 20, 12
 
-    _buffers = {}
 
     ip = models.GenericIPAddressField(blank=True, null=True, help_text='The IP address of the host.')
     hostname = models.CharField(max_length=255, blank=True, null=True, help_text='The hostname of the host.')
     port = models.PositiveIntegerField(default=22, blank=True, null=True, help_text='The port number for accessing the host.')
     save_session = models.ForeignKey(SavedHost, on_delete=models.SET_NULL, related_name='sshdate', blank=True, null=True, default=None, help_text='Saved Host data reference')
-    content = models.TextField(blank=True, null=False, default='', help_text='All terminal content for this ssh session')
+    transcript_size = models.PositiveBigIntegerField(default=0, help_text='Bytes of terminal output stored in transcript chunks')
+    transcript_chunks = models.PositiveIntegerField(default=0, help_text='Number of stored transcript chunks')
 
     @property
     def create_url(self):
@@ -280,17 +296,47 @@ class SSHData(BaseData):
         SSHModule.disconnect(self.id)
         super().close()
 
-    async def read(self):
-        data = await SSHModule.read(await self.__get_session_id())
+    async def start_output(self, callback, on_close=None):
+        ''' Pump the session output, `callback(data, offset)` gets every chunk with the stream offset it ends at '''
+        session_id = await self.__get_session_id()
+        instance_id = self.id
+
+        ring = RingBuffer.get(instance_id)
+        if ring is None:
+            ring = RingBuffer.create(instance_id, await sync_to_async(self.get_transcript_size)())
+
+        async def on_data(data):
+            # Output that has not reached the transcript yet is never overwritten, the reader waits
+            # for the transcript instead. Any other failed flush is retried by the next one.
+            while ring.pending and ring.pending + len(data) > ring.capacity:
+                if not await self.__try_update_content(instance_id):
+                    await asyncio.sleep(self.FLUSH_RETRY_DELAY)
+
+            screen = TerminalScreen.get_or_create(session_id, ring, partial(SSHModule.decode, session_id),
+                                                  SSHModule.get_terminal_size(session_id))
+            offset = ring.append(data)
 
-        if data is not None and data != '':
-            updated_buffer = self.__get_buffer(self.id) + data
-            self.__set_buffer(self.id, updated_buffer)
+            if screen is not None:
+                if screen.backlog > ring.capacity // 2:
+                    # A screen that far behind would lose output to the ring, the reader waits for it.
+                    await screen.update()
+                elif screen.backlog >= screen.FEED_BATCH_BYTES:
+                    screen.schedule()
 
-            if len(updated_buffer) >= self.BUFFER_SIZE_LIMIT:
-                await self.__update_content(self.id)
+            await callback(data, offset)
 
-        return data
+            if ring.pending >= self.BUFFER_SIZE_LIMIT:
+                await self.__try_update_content(instance_id)
+
+        async def on_channel_close():
+            await self.__try_update_content(instance_id)
+            RingBuffer.discard(instance_id)
+            TerminalScreen.discard(session_id)
+
+            if on_close is not None:
+                await on_close()
+
+        SSHModule.start_reader(session_id, on_data, on_channel_close)
 
     async def send(self, data):
         try:
@@ -305,7 +351,7 @@ class SSHData(BaseData):
         except ObjectDoesNotExist:
             return None
 
-    async def connect(self, username=None, password=None, private_key=None, passphrase=None):
+    async def connect(self, username=None, password=None, private_key=None, passphrase=None, join=True):
         await self.check_cache_and_update_flag()
 
         save_session = await self.get_save_session()
@@ -335,7 +381,8 @@ class SSHData(BaseData):
                 password=password,
                 pkey=private_key,
                 passphrase=passphrase,
-                port=port
+                port=port,
+                join=join
             )
         except ReconnectRequired as e:
             session_saved = await self.__check_save_session_exists()
@@ -344,49 +391,154 @@ class SSHData(BaseData):
             raise
 
     async def disconnect(self):
-        await self.__flush_buffer()
         session_id = await self.__get_session_id()
         SSHModule.disconnect(session_id)
+        await self.__flush_buffer()
 
-    async def resize_terminal(self):
-        await SSHModule.resize_terminals_in_group(await self.__get_session_id(),
-                                                  self.TERM_MIN_WIDTH, self.TERM_MIN_HEIGHT)
+        # The last viewer is gone and the reader with it, nothing is appended to the ring anymore.
+        if session_id not in SSHModule.instances:
+            TerminalScreen.discard(session_id)
+            RingBuffer.discard(self.id)
 
-    async def set_terminal_size(self, term_width, term_height):
-        await SSHModule.add_terminals_in_group(await self.__get_session_id(), term_width, term_height)
+    async def set_terminal_size(self, viewer, term_width, term_height):
+        session_id = await self.__get_session_id()
+        SSHModule.set_terminal_size(session_id, viewer, max(self.TERM_MIN_WIDTH, term_width),
+                                    max(self.TERM_MIN_HEIGHT, term_height),
+                                    on_resize=partial(self.__resize_screen, session_id))
 
-    async def del_terminal_size(self, term_width, term_height):
-        await SSHModule.del_terminals_in_group(await self.__get_session_id(), term_width, term_height)
+    async def del_terminal_size(self, viewer):
+        SSHModule.del_terminal_size(await self.__get_session_id(), viewer)
 
+    @staticmethod
+    async def __resize_screen(session_id, columns, lines):
+        screen = TerminalScreen.get(session_id)
+        if screen is not None:
+            await screen.resize(columns, lines)
 
-    @sync_to_async
-    def __get_session_id(self):
-        return self.sessions.all().first().object_id
+    async def __get_session_id(self):
+        # Every SessionsList row of this object points at it through object_id, which is our primary key.
+        return self.id
 
     async def check_cache_and_update_flag(self):
         if cache.get(await self.__get_session_id()) is None:
             self.CACHED_CREDENTIALS = False
 
     @classmethod
-    async def __update_content(cls, instance_id):
-        buffer_content = cls.__get_buffer(instance_id)
-        if buffer_content:
-            instance = await sync_to_async(cls.objects.get)(id=instance_id)
-            instance.content += buffer_content
-            await sync_to_async(instance.save)()
-            cls.__set_buffer(instance_id, '')
+    async def __try_update_content(cls, instance_id) -> bool:
+        try:
+            await cls.__update_content(instance_id)
+        except Exception:
+            logger.exception('Flushing the output of SSH session %s to its transcript failed', instance_id)
+            return False
+        return True
 
     @classmethod
-    def __get_buffer(cls, instance_id):
-        return cls._buffers.setdefault(instance_id, '')
+    async def __update_content(cls, instance_id):
+        ring = RingBuffer.get(instance_id)
+        if ring is None:
+            return
+
+        # The bytes stay pending until stored, a failed write is retried by the next flush.
+        async with ring.flush_lock:
+            if not ring.pending:
+                return
+
+            buffer_content, end = ring.peek_pending()
+            with Metrics.timer('webterminal_transcript_flush_seconds'):
+                seq, offset = await sync_to_async(cls.reserve_transcript)(instance_id, len(buffer_content))
+                try:
+                    await transcript_store.append_async(instance_id, seq, offset, buffer_content)
+                except Exception:
+                    await sync_to_async(cls.reserve_transcript)(instance_id, -len(buffer_content), -1)
+                    raise
+                ring.commit(end)
+                await sync_to_async(index_transcript)(instance_id, offset, buffer_content)
+            Metrics.inc('webterminal_transcript_flushed_bytes_total', len(buffer_content))
 
     @classmethod
-    def __set_buffer(cls, instance_id, data):
-        cls._buffers[instance_id] = data
+    def reserve_transcript(cls, instance_id, length, chunks=1):
+        # Only the counters are touched, so a flush costs the same at any transcript size.
+        # A failed write hands its reservation back with a negative length and count.
+        with transaction.atomic():
+            cls.objects.filter(pk=instance_id).update(
+                transcript_size=F('transcript_size') + length,
+                transcript_chunks=F('transcript_chunks') + chunks,
+            )
+            size, chunks = cls.objects.filter(pk=instance_id).values_list('transcript_size', 'transcript_chunks').get()
+        return chunks - 1, size - length
+
+    def get_transcript_size(self):
+        return SSHData.objects.filter(pk=self.id).values_list('transcript_size', flat=True).get()
 
-    async def get_content(self):
+    async def get_content(self, limit=None):
+        ''' Return the transcript (only its last `limit` bytes if given) and the offsets it starts and ends at '''
         await self.__flush_buffer()
-        return self.content
+        return await sync_to_async(self.read_transcript)(limit=limit)
+
+    def read_transcript(self, before_offset=None, limit=None):
+        size = self.get_transcript_size()
+        end = size if before_offset is None else min(before_offset, size)
+        start = 0 if limit is None else max(0, end - limit)
+
+        text, start = self.__decode_page(transcript_store.read_range(self.id, start, end), start)
+        return text, start, end
+
+    @staticmethod
+    def __decode_page(data, start):
+        # Start the page on a character boundary, pages fetched later end exactly there.
+        skip = 0
+        while start > 0 and skip < min(len(data), 3) and data[skip] & 0xC0 == 0x80:
+            skip += 1
+
+        return data[skip:].decode('utf-8', errors='replace'), start + skip
+
+    async def get_snapshot(self):
+        ''' Screen snapshot when the screen model is available, otherwise the tail of the transcript.
+
+        Returns the text, the transcript offset older scrollback is paged from and the stream offset
+        of the last byte the text reflects.
+        '''
+        screen = TerminalScreen.get(await self.__get_session_id())
+        await self.__flush_buffer()
+        ring = RingBuffer.get(self.id)
+
+        if screen is not None:
+            size = await sync_to_async(self.get_transcript_size)()
+            text, end = await screen.snapshot()
+            return text, size, end
+
+        # The flush above is what lets older pages be read from the transcript, the tail itself
+        # is served from memory while the ring still holds it.
+        start = max(0, ring.end - TERMINAL_INITIAL_SYNC_BYTES) if ring is not None else None
+        if start is not None and ring.start <= start:
+            return *self.__decode_page(ring.since(start), start), ring.end
+
+        return await self.get_content(limit=TERMINAL_INITIAL_SYNC_BYTES)
+
+    async def get_scrollback(self, before_offset, limit):
+        text, start, _ = await sync_to_async(self.read_transcript)(before_offset=before_offset,
+                                                                   limit=min(limit, SCROLLBACK_PAGE_MAX_BYTES))
+        return text, start
+
+    async def get_output_since(self, offset):
+        ''' Raw output printed after stream `offset` and the offset it ends at.
+
+        Served from the ring buffer, or from the transcript once it fell out of it. None when
+        `offset` is unknown to this session or too far behind to be worth replaying.
+        '''
+        ring = RingBuffer.get(self.id)
+        if ring is not None:
+            data = ring.since(offset)
+            if data is not None:
+                return data, ring.end
+
+        await self.__flush_buffer()
+        size = await sync_to_async(self.get_transcript_size)()
+        if offset > size or size - offset > TERMINAL_RESUME_MAX_BYTES:
+            return None
+
+        data = await sync_to_async(transcript_store.read_range)(self.id, offset, size)
+        return data, size
 
     async def __flush_buffer(self):
         await self.__update_content(self.id)
@@ -444,6 +596,39 @@ class SSHData(BaseData):
             ("USE_SSH", "This permission give user ability to use SSH funcjonality"),
         ]
 
+class TranscriptChunk(models.Model):
+    session = models.ForeignKey(SSHData, on_delete=models.CASCADE, related_name='transcript', help_text='SSH session this output belongs to')
+    seq = models.PositiveIntegerField(help_text='Position of the chunk in the transcript')
+    offset = models.PositiveBigIntegerField(help_text='Byte offset of the first byte of this chunk in the transcript')
+    payload = models.BinaryField(help_text='Raw terminal output')
+    created_at = models.DateTimeField(auto_now_add=True, help_text='The date and time when the chunk was stored.')
+
+    class Meta:
+        unique_together = ['session', 'seq']
+        ordering = ['session', 'seq']
+        indexes = [models.Index(fields=['session', 'offset'], name='transcript_session_offset_idx')]
+
+    def __str__(self):
+        return f"Transcript {self.session_id} #{self.seq}"
+
+
+class SearchEntry(models.Model):
+    SSH, NOTE = 'ssh', 'note'
+    KINDS = [(SSH, 'SSH transcript'), (NOTE, 'Note')]
+
+    kind = models.CharField(max_length=4, choices=KINDS, help_text='What the indexed text comes from')
+    object_id = models.PositiveIntegerField(help_text='Primary key of the SSHData or NotesData the text comes from')
+    offset = models.PositiveBigIntegerField(default=0, help_text='Transcript offset of the indexed output (0 for notes)')
+    text = models.TextField(help_text='Indexed text, without ANSI escape sequences')
+    created_at = models.DateTimeField(auto_now_add=True, help_text='The date and time when the text was indexed.')
+
+    class Meta:
+        indexes = [models.Index(fields=['kind', 'object_id'], name='search_kind_object_idx')]
+
+    def __str__(self):
+        return f"Search entry {self.kind} {self.object_id} @{self.offset}"
+
+
 class SessionsList(models.Model):
     name = models.CharField(max_length=100, default='Session', help_text='Name of the tab in fronend.')
     user = models.ForeignKey(AccountData, on_delete=models.CASCADE, related_name='sessions', help_text='The user associated with the session.')
@@ -0,0 +1,154 @@
+import asyncio
+from terminal.executors import screen_executor
+from web.settings import TERMINAL_SCROLLBACK_LINES
+
+try:
+    import pyte
+except ImportError:
+    pyte = None
+
+
+SGR_COLORS = {
+    'black': 0, 'red': 1, 'green': 2, 'brown': 3, 'blue': 4, 'magenta': 5, 'cyan': 6, 'white': 7,
+}
+
+
+class TerminalScreen:
+    ''' Server side VT100/xterm screen of one SSH session, kept up to date by its output stream.
+
+    Viewers that join or reload get `snapshot()` (bounded scrollback plus the visible screen)
+    instead of a replay of everything the session ever printed. Needs the optional `pyte` package.
+
+    pyte is too slow to parse output on the event loop. The screen remembers the stream offset it
+    reached, `update` feeds the rest of the session's ring buffer in a worker thread. The reader
+    schedules it every FEED_BATCH_BYTES, snapshots and resizes catch up before touching the screen.
+    '''
+    DEFAULT_COLUMNS, DEFAULT_LINES = 80, 24
+    FEED_BATCH_BYTES = 16384
+
+    instances = {}
+
+    def __init__(self, ring, decode, columns=DEFAULT_COLUMNS, lines=DEFAULT_LINES, history=TERMINAL_SCROLLBACK_LINES):
+        self.screen = pyte.HistoryScreen(columns, lines, history=history, ratio=0.5)
+        self.stream = pyte.Stream(self.screen)
+        self.ring = ring
+        self.decode = decode
+        self.offset = ring.end
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    @classmethod
+    def get_or_create(cls, group_name, ring, decode, size=None):
+        if pyte is None:
+            return None
+
+        if group_name not in cls.instances:
+            cls.instances[group_name] = cls(ring, decode, *size) if size else cls(ring, decode)
+        return cls.instances[group_name]
+
+    @classmethod
+    def get(cls, group_name):
+        return cls.instances.get(group_name)
+
+    @classmethod
+    def discard(cls, group_name):
+        cls.instances.pop(group_name, None)
+
+    @property
+    def backlog(self):
+        return self.ring.end - self.offset
+
+    async def update(self):
+        async with self.lock:
+            await self.__feed()
+
+    def schedule(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.update())
+
+    async def __feed(self):
+        data = self.ring.since(self.offset)
+        if data is None:
+            # Fell out of the ring, the screen goes on from the oldest output still there.
+            data = self.ring.since(self.ring.start)
+        self.offset = self.ring.end
+
+        # Decoded here, in stream order, only the parsing moves to the thread.
+        if data:
+            await asyncio.get_running_loop().run_in_executor(screen_executor, self.stream.feed, self.decode(data))
+
+    async def resize(self, columns, lines):
+        async with self.lock:
+            # Output written before the resize is laid out at the old size.
+            await self.__feed()
+            if (columns, lines) != (self.screen.columns, self.screen.lines):
+                self.screen.resize(lines=lines, columns=columns)
+
+    async def snapshot(self):
+        ''' The rendered screen and the stream offset it reflects, output read meanwhile comes after it '''
+        async with self.lock:
+            await self.__feed()
+            offset = self.offset
+            return await asyncio.get_running_loop().run_in_executor(screen_executor, self.__render), offset
+
+    def __render(self) -> str:
+        columns = self.screen.columns
+        rows = [self.__render_line(line, columns) for line in self.screen.history.top]
+        rows += [self.__render_line(self.screen.buffer[y], columns) for y in range(self.screen.lines)]
+
+        # Trailing blank rows carry no content, the cursor is moved back relative to the last written row.
+        while rows and not rows[-1]:
+            rows.pop()
+
+        cursor = self.screen.cursor
+        cursor_row = len(self.screen.history.top) + cursor.y
+        last_row = len(rows) - 1
+        move = f'\x1b[{last_row - cursor_row}A' if last_row > cursor_row else '\r\n' * (cursor_row - last_row)
+        return '\r\n'.join(rows) + move + f'\x1b[{cursor.x + 1}G'
+
+    @classmethod
+    def __render_line(cls, line, columns) -> str:
+        chars = [line[x] for x in range(columns)]
+        while chars and chars[-1].data == ' ' and cls.__sgr(chars[-1]) == '0':
+            chars.pop()
+
+        parts = []
+        current = '0'
+        for char in chars:
+            sgr = cls.__sgr(char)
+            if sgr != current:
+                parts.append(f'\x1b[{sgr}m')
+                current = sgr
+            parts.append(char.data)
+
+        if current != '0':
+            parts.append('\x1b[0m')
+        return ''.join(parts)
+
+    @staticmethod
+    def __color(color, base):
+        if color == 'default':
+            return None
+        if color.startswith('bright') and color[6:] in SGR_COLORS:
+            return str(base + 60 + SGR_COLORS[color[6:]])
+        if color in SGR_COLORS:
+            return str(base + SGR_COLORS[color])
+        if len(color) == 6:
+            r, g, b = int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
+            return f'{base + 8};2;{r};{g};{b}'
+        return None
+
+    @classmethod
+    def __sgr(cls, char) -> str:
+        codes = ['0']
+        for flag, code in (('bold', '1'), ('italics', '3'), ('underscore', '4'), ('blink', '5'),
+                           ('reverse', '7'), ('strikethrough', '9')):
+            if getattr(char, flag, False):
+                codes.append(code)
+
+        for color, base in ((char.fg, 30), (char.bg, 40)):
+            code = cls.__color(color, base)
+            if code is not None:
+                codes.append(code)
+
+        return ';'.join(codes)
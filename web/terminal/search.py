@@ -0,0 +1,194 @@
+import asyncio
+import codecs
+import re
+from asgiref.sync import sync_to_async
+from django.db import connection
+from web.settings import SEARCH_NOTE_INDEX_DELAY
+
+# CSI and OSC sequences, DCS/SOS/PM/APC strings and the remaining two-byte escapes
+ANSI_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)?|[PX^_][^\x1b]*(?:\x1b\\)?|[ -/]*[0-~])')
+# The start of one of those sequences, cut off by the end of a chunk
+PARTIAL_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?|[ -/]*)\Z')
+CONTROL_CHARS = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+
+SNIPPET_CHARS = 160
+
+
+def strip_ansi(text: str) -> str:
+    return CONTROL_CHARS.sub('', ANSI_ESCAPE.sub('', text))
+
+
+def note_text(delta) -> str:
+    ops = delta.get('ops', []) if isinstance(delta, dict) else delta or []
+    return ''.join(op['insert'] for op in ops if isinstance(op, dict) and isinstance(op.get('insert'), str))
+
+
+class TranscriptStripper:
+    ''' Plain text of one session's transcript, chunk by chunk.
+
+    Multibyte characters and escape sequences split between two chunks are held back and completed
+    by the next one. A chunk that does not continue where the previous one ended starts over.
+    '''
+    CARRY_MAX = 4096
+
+    instances = {}
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.carry = ''
+
+    @classmethod
+    def get(cls, session_id, offset):
+        stripper = cls.instances.get(session_id)
+        if stripper is None or stripper.offset != offset:
+            stripper = cls.instances[session_id] = cls(offset)
+        return stripper
+
+    @classmethod
+    def discard(cls, session_id):
+        cls.instances.pop(session_id, None)
+
+    def strip(self, payload: bytes) -> str:
+        self.offset += len(payload)
+        text = self.carry + self.decoder.decode(payload)
+
+        partial = PARTIAL_ESCAPE.search(text)
+        if partial is not None and len(text) - partial.start() <= self.CARRY_MAX:
+            text, self.carry = text[:partial.start()], text[partial.start():]
+        else:
+            self.carry = ''
+        return strip_ansi(text)
+
+
+def index_transcript(session_id, offset, payload: bytes):
+    from terminal.models import SearchEntry
+    text = TranscriptStripper.get(session_id, offset).strip(payload)
+    if text.strip():
+        SearchEntry.objects.create(kind=SearchEntry.SSH, object_id=session_id, offset=offset, text=text)
+
+
+def index_note(note_id, delta):
+    # Notes are saved whole, their entry is replaced instead of appended to.
+    from terminal.models import SearchEntry
+    SearchEntry.objects.filter(kind=SearchEntry.NOTE, object_id=note_id).delete()
+    text = note_text(delta)
+    if text.strip():
+        SearchEntry.objects.create(kind=SearchEntry.NOTE, object_id=note_id, text=text)
+
+
+class NoteIndexer:
+    ''' Re-indexes a note once its edits pause for SEARCH_NOTE_INDEX_DELAY seconds instead of on every edit '''
+    timers = {}
+
+    @classmethod
+    def schedule(cls, note_id):
+        timer = cls.timers.pop(note_id, None)
+        if timer is not None:
+            timer.cancel()
+        cls.timers[note_id] = asyncio.get_running_loop().call_later(
+            SEARCH_NOTE_INDEX_DELAY, lambda: asyncio.ensure_future(cls.__index(note_id)))
+
+    @classmethod
+    async def __index(cls, note_id):
+        cls.timers.pop(note_id, None)
+        await sync_to_async(cls.index)(note_id)
+
+    @staticmethod
+    def index(note_id):
+        # The latest content, a note deleted in the meantime only loses its entry.
+        from terminal.models import NotesData
+        index_note(note_id, NotesData.objects.filter(pk=note_id).values_list('content', flat=True).first())
+
+
+def remove_from_index(kind, object_id):
+    from terminal.models import SearchEntry
+    SearchEntry.objects.filter(kind=kind, object_id=object_id).delete()
+    if kind == SearchEntry.SSH:
+        TranscriptStripper.discard(object_id)
+
+
+class SearchBackend:
+    ''' Substring match over SearchEntry, used on databases without a full-text index.
+
+    `scopes` maps an entry kind to the object ids the query may return, results are
+    `(kind, object_id, offset, snippet, created_at)` tuples, most recent first.
+    '''
+
+    def search(self, query, scopes, limit):
+        clause, params = self.scope_sql(scopes)
+        if not clause:
+            return []
+
+        sql = (f'SELECT e.kind, e.object_id, e.{self.qn("offset")}, e.text, e.created_at '
+               f'FROM terminal_searchentry e WHERE e.text LIKE %s AND ({clause}) '
+               f'ORDER BY e.created_at DESC LIMIT %s')
+        rows = self.fetch(sql, [f'%{query}%', *params, limit])
+        return [(kind, object_id, offset, self.snippet(text, query), created_at)
+                for kind, object_id, offset, text, created_at in rows]
+
+    @staticmethod
+    def qn(name):
+        return connection.ops.quote_name(name)
+
+    @staticmethod
+    def scope_sql(scopes):
+        clauses, params = [], []
+        for kind, ids in scopes.items():
+            if ids:
+                clauses.append(f'(e.kind = %s AND e.object_id IN ({", ".join(["%s"] * len(ids))}))')
+                params += [kind, *ids]
+        return ' OR '.join(clauses), params
+
+    @staticmethod
+    def fetch(sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    @staticmethod
+    def snippet(text, query):
+        position = max(0, text.lower().find(query.lower()))
+        start = max(0, position - SNIPPET_CHARS // 2)
+        return text[start:start + SNIPPET_CHARS]
+
+
+class SQLiteSearchBackend(SearchBackend):
+    ''' FTS5 table `terminal_searchentry_fts`, kept in sync with SearchEntry by triggers '''
+
+    def search(self, query, scopes, limit):
+        clause, params = self.scope_sql(scopes)
+        terms = ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+        if not clause or not terms:
+            return []
+
+        sql = (f'SELECT e.kind, e.object_id, e.{self.qn("offset")}, '
+               f"snippet(terminal_searchentry_fts, 0, '', '', '...', 24), e.created_at "
+               f'FROM terminal_searchentry_fts JOIN terminal_searchentry e ON e.id = terminal_searchentry_fts.rowid '
+               f'WHERE terminal_searchentry_fts MATCH %s AND ({clause}) ORDER BY e.created_at DESC LIMIT %s')
+        return self.fetch(sql, [terms, *params, limit])
+
+
+class PostgresSearchBackend(SearchBackend):
+    ''' GIN index over `to_tsvector('simple', text)` '''
+
+    def search(self, query, scopes, limit):
+        clause, params = self.scope_sql(scopes)
+        if not clause:
+            return []
+
+        sql = (f'SELECT e.kind, e.object_id, e.{self.qn("offset")}, '
+               f"ts_headline('simple', e.text, q, 'MaxFragments=1, MaxWords=24, MinWords=8, StartSel=\"\", StopSel=\"\"'), "
+               f'e.created_at FROM terminal_searchentry e, plainto_tsquery(\'simple\', %s) q '
+               f"WHERE to_tsvector('simple', e.text) @@ q AND ({clause}) ORDER BY e.created_at DESC LIMIT %s")
+        return self.fetch(sql, [query, *params, limit])
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def search_backend() -> SearchBackend:
+    return BACKENDS.get(connection.vendor, SearchBackend)()
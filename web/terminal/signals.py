@@ -1,12 +1,20 @@
+import logging
 from web.settings import MAX_SSH_SESSIONS, MAX_NOTE_SESSIONS, MAX_NOTE_SHARING, MAX_SSH_SHARING, MAX_USER_NOTE_SESSIONS, MAX_USER_SSH_SESSIONS
-from django.db.models.signals import pre_save, post_delete, pre_delete
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
-from terminal.models import SessionsList, SSHData, NotesData
+from terminal.models import SessionsList, SSHData, NotesData, SavedHost, SearchEntry
+from terminal.keys import KeyAgent
+from terminal.transcripts import transcript_store
+from terminal.search import remove_from_index
+from terminal.broadcast import message_frame
 from django.contrib.contenttypes.models import ContentType
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
+logger = logging.getLogger(__name__)
+
 @receiver(post_delete, sender=SessionsList)
 def sessions_list_deleted(sender, instance, **kwargs):
     if instance.content_object and (
@@ -72,12 +80,57 @@ def closing_shared_tabs(sender, instance, **kwargs):
     for session in related_sessions:
         message = {
             'type': 'group_message',
-            'message': {
-                'type': 'action',
-                'content': {'type': 'del_tab', 'session_id': session.id},
-                'to_myself': False,
-                'exclusive': False,
-                'sender_channel_name': None
-            }
+            'frame': message_frame({'type': 'action', 'content': {'type': 'del_tab', 'session_id': session.id}}),
+            'to_myself': False,
+            'exclusive': False,
+            'sender_channel_name': None
         }
         async_to_sync(channel_layer.group_send)(str(instance.id), message)
+
+
+@receiver(pre_save, sender=SavedHost)
+@receiver(post_delete, sender=SavedHost)
+def purge_saved_host_key(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+
+    previous = SavedHost.objects.filter(pk=instance.pk).values('private_key', 'passphrase').first()
+    previous = previous or {'private_key': instance.private_key, 'passphrase': instance.passphrase}
+    if previous['private_key']:
+        KeyAgent.purge(previous['private_key'], previous['passphrase'])
+
+
+@receiver(post_delete, sender=SSHData)
+def delete_transcript(sender, instance, **kwargs):
+    transcript_store.delete(instance.pk)
+
+
+@receiver(post_delete, sender=SSHData)
+@receiver(post_delete, sender=NotesData)
+def delete_search_entries(sender, instance, **kwargs):
+    remove_from_index(SearchEntry.SSH if sender is SSHData else SearchEntry.NOTE, instance.pk)
+
+
+def invalidate_session_context(group_name):
+    # Viewers reload the rows once they are committed, a channel layer outage must not fail the save itself.
+    def send():
+        try:
+            async_to_sync(get_channel_layer().group_send)(group_name, {'type': 'session.invalidate'})
+        except Exception:
+            logger.exception('Could not invalidate the cached context of session %s', group_name)
+
+    transaction.on_commit(send)
+
+
+@receiver(post_save, sender=SessionsList)
+@receiver(post_delete, sender=SessionsList)
+def session_changed(sender, instance, **kwargs):
+    invalidate_session_context(str(instance.object_id))
+
+
+@receiver(post_save, sender=SSHData)
+@receiver(post_save, sender=NotesData)
+@receiver(post_delete, sender=SSHData)
+@receiver(post_delete, sender=NotesData)
+def session_data_changed(sender, instance, **kwargs):
+    invalidate_session_context(str(instance.pk))
@@ -1,157 +1,418 @@
-import socket
-import paramiko
-from paramiko.ssh_exception import AuthenticationException, SSHException, BadHostKeyException, \
-    NoValidConnectionsError, PasswordRequiredException
 import asyncio
-from io import StringIO
-from terminal.errors import ReconnectRequired
+import codecs
+import hashlib
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+from django.utils.module_loading import import_string
+from terminal.metrics import Metrics
+from terminal.tracing import LatencyTracer
+from terminal.ssh_backends import SSHBackend
+from web.settings import SSH_BACKEND, SSH_POOL_IDLE_TIMEOUT, SSH_HEALTH_CHECK_INTERVAL, SSH_RESIZE_DEBOUNCE
+
+logger = logging.getLogger(__name__)
 
 
 class SSHModule:
+    READ_SIZE_MIN, READ_SIZE_MAX = 1024, 65536
+
     instances = {}
     channels = {}
     active_connections = {}
+    readers = {}
+    writers = {}
+    input_buffers = {}
+    close_callbacks = {}
+    read_sizes = {}
+    decoders = {}
+    # Joins of one group are serialized so concurrent viewers share one connection
+    connect_locks = {}
+
+    # Authenticated connections shared by every group opened with the same host, user and credentials
+    pool = {}
+    pool_keys = {}
+    pool_refs = {}
+    pool_locks = {}
+    pool_expiry = {}
+
+    # Viewer sizes of each group: {viewer: (width, height)}, a multiset of widths and heights
+    # and the minimum of each, updated incrementally
     terminal_sizes = {}
+    size_counts = {}
+    min_sizes = {}
+    applied_sizes = {}
+    resize_timers = {}
+    resize_callbacks = {}
+
+    monitor = None
+    # The event loop the connections live on, recorded by every join
+    loop = None
+
+    backend: SSHBackend = import_string(SSH_BACKEND)()
 
     @classmethod
     async def connect_or_create_instance(cls, group_name, host, username, password, port=None, pkey=None,
-                                         passphrase=None):
-        instance = cls()
-        try:
-            ssh = await instance.__connect(host, username, password, port, pkey, passphrase)
-        # TODO: For future cleanup if we do not want to manage specific exceptions
-        except BadHostKeyException:
-            raise
-        except NoValidConnectionsError:
-            raise
-        except PasswordRequiredException as e:
-            raise ReconnectRequired(message=e)
-        except AuthenticationException as e:
-            raise ReconnectRequired(message=e)
-        except SSHException as e:
-            raise ReconnectRequired(message=e)
-        except socket.error:
-            raise
-        except Exception:
-            raise
+                                         passphrase=None, join=True):
+        ''' Connect the group if it is not, `join` counts one more viewer (a reconnect of the group's
+        viewers does not, they are still counted from before the drop) '''
+        cls.loop = asyncio.get_running_loop()
+        async with cls.__locked(cls.connect_locks, group_name):
+            if group_name not in cls.instances:
+                key = cls.__pool_key(host, port, username, password, pkey, passphrase)
+                cls.instances[group_name] = await cls.__acquire(key, host, username, password, port, pkey, passphrase)
+                cls.pool_keys[group_name] = key
 
-        if group_name not in cls.instances:
-            cls.instances[group_name] = ssh
-            cls.active_connections[group_name] = 1
-        else:
-            cls.active_connections[group_name] += 1
-            ssh.close()
+            if join or group_name not in cls.active_connections:
+                cls.active_connections[group_name] = cls.active_connections.get(group_name, 0) + 1
 
-        try:
             await cls.__open_channel(group_name)
-        except SSHException:
-            raise
+        cls.__start_monitor()
 
     @staticmethod
-    async def __connect(host, username, password, port, pkey, passphrase):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        loop = asyncio.get_running_loop()
+    @asynccontextmanager
+    async def __locked(locks, key):
+        ''' Hold the lock of `key`, the entry is dropped once nobody holds or waits for it '''
+        lock, users = locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        locks[key] = lock, users + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = locks[key]
+            if users > 1:
+                locks[key] = lock, users - 1
+            else:
+                del locks[key]
+
+    @staticmethod
+    def __pool_key(host, port, username, password, pkey, passphrase):
+        fingerprint = hashlib.sha256()
+        for value in (password, pkey, passphrase):
+            fingerprint.update(str(value).encode('utf-8') + b'\0')
+        return host, port, username, fingerprint.hexdigest()
+
+    @classmethod
+    async def __acquire(cls, key, host, username, password, port, pkey, passphrase):
+        async with cls.__locked(cls.pool_locks, key):
+            expiry = cls.pool_expiry.pop(key, None)
+            if expiry is not None:
+                expiry.cancel()
+
+            ssh = cls.pool.get(key)
+            if ssh is not None and cls.backend.is_connection_active(ssh):
+                cls.pool_refs[key] += 1
+                return ssh
+
+            if ssh is not None:
+                cls.backend.close(ssh)
+
+            ssh = await cls.backend.connect(host, username, password, port, pkey, passphrase)
+            cls.pool[key] = ssh
+            cls.pool_refs[key] = 1
+            return ssh
+
+    @classmethod
+    def __release(cls, key):
+        if key not in cls.pool_refs:
+            return
+
+        cls.pool_refs[key] -= 1
+        if cls.pool_refs[key] > 0:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            cls.__expire(key)
+            return
 
-        if port is None:
-            port = 22
+        cls.pool_expiry[key] = loop.call_later(SSH_POOL_IDLE_TIMEOUT, cls.__expire, key)
 
-        if pkey is not None:
-            pkey_str = StringIO(pkey)
-            pkey = paramiko.RSAKey.from_private_key(pkey_str, password=passphrase)
+    @classmethod
+    def __expire(cls, key):
+        if cls.pool_refs.get(key):
+            return
 
-        await loop.run_in_executor(None, lambda: ssh.connect(hostname=host, port=port, username=username,
-                                                             password=password, pkey=pkey))
+        ssh = cls.pool.pop(key, None)
+        if ssh is not None:
+            cls.backend.close(ssh)
 
-        return ssh
+        cls.pool_refs.pop(key, None)
+        cls.pool_expiry.pop(key, None)
 
     @classmethod
     async def __open_channel(cls, group_name):
         if group_name not in cls.channels:
             ssh = cls.instances.get(group_name)
-            try:
-                loop = asyncio.get_running_loop()
-                transport = await loop.run_in_executor(None, ssh.get_transport)
-                channel = await loop.run_in_executor(None, transport.open_session)
-                await loop.run_in_executor(None, lambda: channel.get_pty(term='xterm'))
-                await loop.run_in_executor(None, channel.invoke_shell)
-                channel.setblocking(0)
-                cls.channels[group_name] = channel
-            except Exception:
-                raise
+            cls.channels[group_name] = await cls.backend.open_channel(ssh)
+            cls.applied_sizes.pop(group_name, None)
+            cls.__schedule_resize(group_name)
+
+    @staticmethod
+    def __running_loop():
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
 
     @classmethod
     def disconnect(cls, group_name):
+        # Deleting a session gets here from a sync view thread, the group is left on its own loop.
+        if cls.loop is not None and not cls.loop.is_closed() and cls.__running_loop() is not cls.loop:
+            cls.loop.call_soon_threadsafe(cls.disconnect, group_name)
+            return
+
         if group_name in cls.active_connections:
             cls.active_connections[group_name] -= 1
 
             if cls.active_connections[group_name] == 0:
-                ssh_client = cls.instances.get(group_name)
+                del cls.active_connections[group_name]
+                cls.terminal_sizes.pop(group_name, None)
+                cls.size_counts.pop(group_name, None)
+                cls.min_sizes.pop(group_name, None)
+                cls.resize_callbacks.pop(group_name, None)
+                cls.__teardown(group_name)
+
+    @classmethod
+    def __teardown(cls, group_name):
+        ''' Close the channel and release the transport of a group, its viewers and their sizes stay counted '''
+        channel = cls.channels.get(group_name)
+
+        if channel:
+            cls.backend.close_channel(channel)
+        if group_name in cls.pool_keys:
+            cls.__release(cls.pool_keys.pop(group_name))
+
+        if group_name in cls.instances:
+            del cls.instances[group_name]
+        if group_name in cls.channels:
+            del cls.channels[group_name]
+        cls.applied_sizes.pop(group_name, None)
+        timer = cls.resize_timers.pop(group_name, None)
+        if timer is not None:
+            timer.cancel()
+        cls.read_sizes.pop(group_name, None)
+        cls.decoders.pop(group_name, None)
+        cls.close_callbacks.pop(group_name, None)
+        cls.input_buffers.pop(group_name, None)
+        Metrics.forget(session=group_name)
+        LatencyTracer.discard(group_name)
+
+        current = asyncio.current_task() if cls.__running_loop() is not None else None
+        for task in (cls.readers.pop(group_name, None), cls.writers.pop(group_name, None)):
+            if task and not task.done() and task is not current:
+                task.cancel()
+
+    @classmethod
+    def __start_monitor(cls):
+        if cls.monitor is None or cls.monitor.done():
+            cls.monitor = asyncio.create_task(cls.__monitor())
+
+    @classmethod
+    async def __monitor(cls):
+        # Keepalives make the transport notice a half-open peer, this loop reaps what they killed.
+        while cls.instances:
+            await asyncio.sleep(SSH_HEALTH_CHECK_INTERVAL)
+
+            for group_name in list(cls.instances):
                 channel = cls.channels.get(group_name)
+                ssh = cls.instances.get(group_name)
 
-                if channel:
-                    channel.close()
-                if ssh_client:
-                    ssh_client.close()
+                if channel and cls.backend.is_active(channel) and cls.backend.is_connection_active(ssh):
+                    continue
 
-                if group_name in cls.instances:
-                    del cls.instances[group_name]
-                if group_name in cls.channels:
-                    del cls.channels[group_name]
-                if group_name in cls.active_connections:
-                    del cls.active_connections[group_name]
-                if group_name in cls.terminal_sizes:
-                    del cls.terminal_sizes[group_name]
+                await cls.__drop(group_name)
+
+    @classmethod
+    async def __drop(cls, group_name):
+        if group_name not in cls.instances:
+            return
+
+        on_close = cls.close_callbacks.get(group_name)
+        cls.__teardown(group_name)
+
+        if on_close is not None:
+            try:
+                await on_close()
+            except Exception:
+                logger.exception('Close callback of SSH group %s failed', group_name)
 
     @classmethod
     async def send(cls, group_name, data):
         channel = cls.channels.get(group_name)
 
-        if not channel or not channel.active:
+        if not channel or not cls.backend.is_active(channel):
             raise Exception("Channel closed. Try reconnecting")
 
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, channel.send, data)
+        buffer = cls.input_buffers.setdefault(group_name, bytearray())
+        buffer += data.encode('utf-8') if isinstance(data, str) else data
+
+        writer = cls.writers.get(group_name)
+        if writer is None or writer.done():
+            cls.writers[group_name] = asyncio.create_task(cls.__write(group_name))
+
+    @classmethod
+    async def __write(cls, group_name):
+        # One writer per group: input queued while a send is in flight goes out together in the next one.
+        try:
+            while cls.input_buffers.get(group_name):
+                data = bytes(cls.input_buffers[group_name])
+                cls.input_buffers[group_name] = bytearray()
+
+                channel = cls.channels.get(group_name)
+                if not channel:
+                    break
+                await cls.backend.send(channel, data)
+                LatencyTracer.mark(group_name, 'written', after='gateway')
+                Metrics.inc('webterminal_input_bytes_total', len(data))
+                Metrics.inc('webterminal_session_input_bytes_total', len(data), session=group_name)
+        except Exception:
+            # The channel is gone, the reader reports it and the pending input has nowhere to go.
+            cls.input_buffers.pop(group_name, None)
+        finally:
+            if cls.writers.get(group_name) is asyncio.current_task():
+                del cls.writers[group_name]
 
     @classmethod
     async def read(cls, group_name):
         channel = cls.channels.get(group_name)
 
-        if not channel or not channel.active:
+        if not channel or not cls.backend.is_active(channel):
+            return
+
+        read_size = cls.read_sizes.get(group_name, cls.READ_SIZE_MIN)
+        data = await cls.backend.recv(channel, read_size)
+        Metrics.inc('webterminal_output_bytes_total', len(data))
+        Metrics.inc('webterminal_session_output_bytes_total', len(data), session=group_name)
+
+        # Grow the request while reads come back full (bulk output), shrink back for interactive echoes.
+        if len(data) >= read_size:
+            cls.read_sizes[group_name] = min(read_size * 2, cls.READ_SIZE_MAX)
+        elif len(data) < read_size // 4:
+            cls.read_sizes[group_name] = max(read_size // 2, cls.READ_SIZE_MIN)
+
+        return data or None
+
+    @classmethod
+    def decode(cls, group_name, data):
+        # Multibyte characters split across two reads are kept until the rest arrives.
+        if group_name not in cls.decoders:
+            cls.decoders[group_name] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        return cls.decoders[group_name].decode(data)
+
+    @classmethod
+    def start_reader(cls, group_name, callback, on_close=None):
+        reader = cls.readers.get(group_name)
+        if reader is not None and not reader.done():
+            return
+
+        if group_name not in cls.channels:
             return
 
-        loop = asyncio.get_event_loop()
+        cls.close_callbacks[group_name] = on_close
+        cls.readers[group_name] = asyncio.create_task(cls.__pump(group_name, callback))
+
+    @classmethod
+    async def __pump(cls, group_name, callback):
+        # One reader per group: the backend wakes it up as soon as the channel is readable
+        # and every chunk is handed to the callback exactly once.
+        # A chunk the callback fails on (transcript flush, channel layer) is logged and skipped,
+        # a failing channel ends the session so the viewers are told to reconnect.
         try:
-            data = await loop.run_in_executor(None, channel.recv, 1024)
-            decoded_data = data.decode('utf-8')
-            return decoded_data
-        except (paramiko.buffered_pipe.PipeTimeout, socket.timeout):
-            pass
+            while True:
+                data = await cls.read(group_name)
+                if data is None:
+                    break
+                LatencyTracer.mark(group_name, 'read', after='written')
+
+                try:
+                    await callback(data)
+                except Exception:
+                    logger.exception('Output of SSH group %s could not be handled', group_name)
+        except Exception:
+            logger.exception('Reading from SSH group %s failed', group_name)
+        finally:
+            if cls.readers.get(group_name) is asyncio.current_task():
+                del cls.readers[group_name]
+
+        await cls.__drop(group_name)
 
     @classmethod
-    async def resize_terminals_in_group(cls, group_name, term_min_width, term_min_height):
-        if group_name not in cls.terminal_sizes or not cls.terminal_sizes[group_name]:
+    def set_terminal_size(cls, group_name, viewer, term_width, term_height, on_resize=None):
+        ''' Register (or update) the size of one viewer, the PTY follows the smallest viewer '''
+        previous = cls.terminal_sizes.setdefault(group_name, {}).get(viewer)
+        if previous == (term_width, term_height):
             return
 
-        min_width = max(term_min_width, min(size[0] for size in cls.terminal_sizes[group_name]))
-        min_height = max(term_min_height, min(size[1] for size in cls.terminal_sizes[group_name]))
+        if previous is not None:
+            cls.__count_size(group_name, previous, -1)
+        cls.terminal_sizes[group_name][viewer] = (term_width, term_height)
+        cls.__count_size(group_name, (term_width, term_height), 1)
 
-        channel = cls.channels.get(group_name)
-        if channel and channel.active:
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, lambda: channel.resize_pty(width=min_width, height=min_height))
+        if on_resize is not None:
+            cls.resize_callbacks[group_name] = on_resize
+        cls.__schedule_resize(group_name)
+
+    @classmethod
+    def del_terminal_size(cls, group_name, viewer):
+        previous = cls.terminal_sizes.get(group_name, {}).pop(viewer, None)
+        if previous is None:
+            return
+
+        cls.__count_size(group_name, previous, -1)
+        if not cls.terminal_sizes[group_name]:
+            del cls.terminal_sizes[group_name]
+        cls.__schedule_resize(group_name)
+
+    @classmethod
+    def __count_size(cls, group_name, size, delta):
+        # A new minimum is only searched for when the last viewer with the current one leaves.
+        counters = cls.size_counts.setdefault(group_name, (Counter(), Counter()))
+        minimum = cls.min_sizes.setdefault(group_name, [None, None])
+
+        for axis, value in enumerate(size):
+            counter = counters[axis]
+            counter[value] += delta
+            if counter[value] <= 0:
+                del counter[value]
+
+            if delta > 0 and (minimum[axis] is None or value < minimum[axis]):
+                minimum[axis] = value
+            elif delta < 0 and value == minimum[axis] and value not in counter:
+                minimum[axis] = min(counter) if counter else None
 
     @classmethod
-    async def add_terminals_in_group(cls, group_name, term_width, term_height):
-        if group_name not in cls.terminal_sizes:
-            cls.terminal_sizes[group_name] = set()
-        cls.terminal_sizes[group_name].add((term_width, term_height))
+    def get_terminal_size(cls, group_name):
+        minimum = cls.min_sizes.get(group_name)
+        if minimum is None or None in minimum:
+            return None
+        return tuple(minimum)
+
+    @classmethod
+    def __schedule_resize(cls, group_name):
+        # Every change within the window is folded into one resize of the PTY.
+        if group_name in cls.resize_timers or group_name not in cls.channels:
+            return
+
+        loop = asyncio.get_running_loop()
+        cls.resize_timers[group_name] = loop.call_later(
+            SSH_RESIZE_DEBOUNCE, lambda: asyncio.ensure_future(cls.__apply_resize(group_name)))
 
     @classmethod
-    async def del_terminals_in_group(cls, group_name, term_width, term_height):
-        if group_name in cls.terminal_sizes:
-            cls.terminal_sizes.get(group_name, set()).discard((term_width, term_height))
+    async def __apply_resize(cls, group_name):
+        cls.resize_timers.pop(group_name, None)
+        size = cls.get_terminal_size(group_name)
+        channel = cls.channels.get(group_name)
+
+        if size is None or size == cls.applied_sizes.get(group_name):
+            return
+        if not channel or not cls.backend.is_active(channel):
+            return
 
-            if not cls.terminal_sizes.get(group_name):
-                del cls.terminal_sizes[group_name]
+        cls.applied_sizes[group_name] = size
+        await cls.backend.resize(channel, *size)
 
+        on_resize = cls.resize_callbacks.get(group_name)
+        if on_resize is not None:
+            await on_resize(*size)
@@ -0,0 +1,264 @@
+import socket
+import asyncio
+from abc import ABC, abstractmethod
+from io import StringIO
+import paramiko
+from paramiko.ssh_exception import AuthenticationException, SSHException, BadHostKeyException, \
+    NoValidConnectionsError, PasswordRequiredException
+from django.core.exceptions import ImproperlyConfigured
+from terminal.errors import ReconnectRequired
+from terminal.executors import connect_executor, data_executor, keepalive_executor
+from terminal.keys import KeyAgent
+from web.settings import SSH_KEEPALIVE_INTERVAL, SSH_KEEPALIVE_COUNT_MAX, SSH_SEND_TIMEOUT
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+class SSHBackend(ABC):
+    ''' Transport used by SSHModule to talk to the remote host '''
+    DEFAULT_PORT = 22
+    TERM_TYPE = 'xterm'
+
+    @abstractmethod
+    async def connect(self, host, username, password, port, pkey, passphrase):
+        ''' Authenticate and return a connection object. Auth problems raise ReconnectRequired. '''
+
+    @abstractmethod
+    async def open_channel(self, connection):
+        ''' Open an interactive shell with a PTY on the connection and return the channel. '''
+
+    @abstractmethod
+    async def send(self, channel, data: bytes):
+        ''' Write all of `data`, in order '''
+
+    @abstractmethod
+    async def recv(self, channel, size) -> bytes:
+        ''' Wait until data is available and return it. Empty bytes means the channel reached EOF. '''
+
+    @abstractmethod
+    async def resize(self, channel, width, height):
+        ...
+
+    @abstractmethod
+    def is_active(self, channel) -> bool:
+        ...
+
+    @abstractmethod
+    def is_connection_active(self, connection) -> bool:
+        ...
+
+    @abstractmethod
+    def close_channel(self, channel):
+        ...
+
+    @abstractmethod
+    def close(self, connection):
+        ...
+
+
+class ParamikoBackend(SSHBackend):
+    ''' Blocking paramiko client, blocking calls run in the dedicated SSH thread pools '''
+    KEEPALIVE_REQUEST = 'keepalive@openssh.com'
+
+    def __init__(self):
+        self.keepalives = set()
+
+    async def connect(self, host, username, password, port, pkey, passphrase):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        loop = asyncio.get_running_loop()
+
+        if port is None:
+            port = self.DEFAULT_PORT
+
+        try:
+            if pkey is not None:
+                pkey = await KeyAgent.load(pkey, passphrase, self.parse_key)
+
+            await loop.run_in_executor(connect_executor, lambda: ssh.connect(hostname=host, port=port,
+                                                                             username=username, password=password,
+                                                                             pkey=pkey))
+        # TODO: For future cleanup if we do not want to manage specific exceptions
+        except BadHostKeyException:
+            raise
+        except NoValidConnectionsError:
+            raise
+        except PasswordRequiredException as e:
+            raise ReconnectRequired(message=e)
+        except AuthenticationException as e:
+            raise ReconnectRequired(message=e)
+        except SSHException as e:
+            raise ReconnectRequired(message=e)
+
+        keepalive = asyncio.create_task(self.__keepalive(ssh.get_transport()))
+        self.keepalives.add(keepalive)
+        keepalive.add_done_callback(self.keepalives.discard)
+        return ssh
+
+    async def __keepalive(self, transport):
+        # paramiko's own keepalive never waits for a reply, so it cannot tell a dead peer from a quiet one.
+        # Replies are awaited here (a failure reply counts too) and the transport is closed after
+        # SSH_KEEPALIVE_COUNT_MAX intervals without one, the health check then reaps its sessions.
+        # The intervals are counted from when the request is sent, not while it waits for a thread
+        # held by other silent peers.
+        loop = asyncio.get_running_loop()
+
+        def request(started):
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+            return transport.global_request(self.KEEPALIVE_REQUEST, None, True)
+
+        while transport.is_active():
+            await asyncio.sleep(SSH_KEEPALIVE_INTERVAL)
+            if not transport.is_active():
+                return
+
+            started = loop.create_future()
+            reply = loop.run_in_executor(keepalive_executor, request, started)
+            await started
+            for _ in range(SSH_KEEPALIVE_COUNT_MAX):
+                done, pending = await asyncio.wait((reply,), timeout=SSH_KEEPALIVE_INTERVAL)
+                if done:
+                    break
+            else:
+                transport.close()
+
+    @staticmethod
+    def parse_key(text):
+        for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey, paramiko.DSSKey):
+            try:
+                return key_class.from_private_key(StringIO(text))
+            except PasswordRequiredException as e:
+                raise ReconnectRequired(message=e)
+            except SSHException:
+                continue
+        raise ReconnectRequired(message='Unsupported private key type')
+
+    async def open_channel(self, connection):
+        loop = asyncio.get_running_loop()
+        transport = await loop.run_in_executor(connect_executor, connection.get_transport)
+        channel = await loop.run_in_executor(connect_executor, transport.open_session)
+        await loop.run_in_executor(connect_executor, lambda: channel.get_pty(term=self.TERM_TYPE))
+        await loop.run_in_executor(connect_executor, channel.invoke_shell)
+        channel.setblocking(0)
+        return channel
+
+    async def send(self, channel, data):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(data_executor, self.__send_all, channel, data)
+
+    @staticmethod
+    def __send_all(channel, data):
+        # The channel is non-blocking (the reader relies on it): a full SSH window raises
+        # instead of waiting, and a send may take only part of the data. The thread then sleeps on
+        # the condition paramiko notifies when the window opens or the channel closes.
+        while data:
+            try:
+                sent = channel.send(data)
+            except socket.timeout:
+                with channel.lock:
+                    opened = channel.out_buffer_cv.wait_for(lambda: channel.out_window_size or channel.closed,
+                                                            SSH_SEND_TIMEOUT)
+                if not opened:
+                    raise socket.timeout(f'SSH window stayed closed for {SSH_SEND_TIMEOUT} seconds')
+                continue
+
+            if not sent:
+                raise socket.error('Channel closed')
+            data = data[sent:]
+
+    async def recv(self, channel, size):
+        while True:
+            try:
+                return channel.recv(size)
+            except (paramiko.buffered_pipe.PipeTimeout, socket.timeout):
+                pass
+
+            await self.__wait_readable(channel)
+
+    @staticmethod
+    async def __wait_readable(channel):
+        # The channel's pipe fd becomes readable as soon as paramiko buffers data (or on EOF).
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = channel.fileno()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+
+    async def resize(self, channel, width, height):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(data_executor, lambda: channel.resize_pty(width=width, height=height))
+
+    def is_active(self, channel):
+        return channel.active and not channel.closed
+
+    def is_connection_active(self, connection):
+        transport = connection.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close_channel(self, channel):
+        channel.close()
+
+    def close(self, connection):
+        connection.close()
+
+
+class AsyncSSHBackend(SSHBackend):
+    ''' Native asyncio client (asyncssh), no thread pool hops on the data path '''
+
+    def __init__(self):
+        if asyncssh is None:
+            raise ImproperlyConfigured("AsyncSSHBackend requires the 'asyncssh' package.")
+        # connection -> task finishing when it closes, asyncssh has no public "is closed" check
+        self.closed_waiters = {}
+
+    async def connect(self, host, username, password, port, pkey, passphrase):
+        if port is None:
+            port = self.DEFAULT_PORT
+
+        try:
+            client_keys = [await KeyAgent.load(pkey, passphrase, asyncssh.import_private_key)] \
+                if pkey is not None else ()
+            connection = await asyncssh.connect(host, port=port, username=username, password=password,
+                                                client_keys=client_keys, known_hosts=None,
+                                                keepalive_interval=SSH_KEEPALIVE_INTERVAL,
+                                                keepalive_count_max=SSH_KEEPALIVE_COUNT_MAX)
+        except (asyncssh.KeyImportError, asyncssh.KeyEncryptionError) as e:
+            raise ReconnectRequired(message=e)
+        except asyncssh.Error as e:
+            raise ReconnectRequired(message=e)
+
+        self.closed_waiters[connection] = asyncio.ensure_future(connection.wait_closed())
+        return connection
+
+    async def open_channel(self, connection):
+        return await connection.create_process(term_type=self.TERM_TYPE, encoding=None)
+
+    async def send(self, channel, data):
+        channel.stdin.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    async def recv(self, channel, size):
+        return await channel.stdout.read(size)
+
+    async def resize(self, channel, width, height):
+        channel.change_terminal_size(width, height)
+
+    def is_active(self, channel):
+        return not channel.channel.is_closing()
+
+    def is_connection_active(self, connection):
+        closed = self.closed_waiters.get(connection)
+        return closed is not None and not closed.done()
+
+    def close_channel(self, channel):
+        channel.close()
+
+    def close(self, connection):
+        connection.close()
+        # Nobody asks about a connection once it is closed, its waiter finishes on its own.
+        self.closed_waiters.pop(connection, None)
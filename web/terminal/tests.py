@@ -1,3 +1,864 @@
-from django.test import TestCase
+import asyncio
+import socket
+import tempfile
+import threading
+import redis
+from asgiref.sync import async_to_sync
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from web.settings import CHANNEL_LAYERS
+from terminal.broadcast import ViewerOutbox, output_frame, frame_payload
+from terminal.consumers import SessionCosumer
+from terminal.gateway import SSHGateway, SSHGatewayConsumer
+from terminal.layers import LocalFanoutChannelLayer
+from terminal.buffers import RingBuffer
+from terminal.metrics import Metrics
+from terminal.models import AccountData, NotesData, SSHData
+from terminal.screen import TerminalScreen
+from terminal.search import NoteIndexer, TranscriptStripper
+from terminal.transcripts import FileTranscriptStore
+from terminal.ssh import SSHModule
+from terminal.ssh_backends import SSHBackend, ParamikoBackend, AsyncSSHBackend, asyncssh
+from terminal.management.commands.benchmark_ssh import EchoServer, echo_shell
 
-# Create your tests here.
+
+REDIS_HOSTS = CHANNEL_LAYERS['default']['CONFIG']['hosts']
+
+
+def redis_available():
+    host, port = REDIS_HOSTS[0]
+    try:
+        return redis.Redis(host=host, port=port, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+
+
+class LocalFanoutChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        if not redis_available():
+            self.skipTest('Redis is not reachable')
+        self.layer = LocalFanoutChannelLayer(hosts=REDIS_HOSTS, prefix='test-webterminal')
+
+    @asynccontextmanager
+    async def member(self, group):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add(group, channel)
+        try:
+            yield channel
+        finally:
+            await self.layer.flush()
+            await self.layer.close_pools()
+
+    async def test_single_local_viewer_receives_group_message(self):
+        # The only receiver of the process is the one blocked on Redis, the local message has to wake it up.
+        async with self.member('session') as channel:
+            receive = asyncio.ensure_future(self.layer.receive(channel))
+            await asyncio.sleep(0.1)
+
+            await self.layer.group_send('session', {'type': 'group.message', 'frame': 'hello'})
+
+            self.assertEqual(await asyncio.wait_for(receive, 1), {'type': 'group.message', 'frame': 'hello'})
+
+    async def test_remote_message_after_local_one(self):
+        async with self.member('session') as channel:
+            await self.layer.group_send('session', {'type': 'local'})
+            self.assertEqual((await asyncio.wait_for(self.layer.receive(channel), 1))['type'], 'local')
+
+            # The Redis receive started by the first call is still pending and picks up a direct send.
+            await self.layer.send(channel, {'type': 'direct'})
+            self.assertEqual((await asyncio.wait_for(self.layer.receive(channel), 1))['type'], 'direct')
+
+    async def test_local_members_are_not_published(self):
+        async with self.member('session') as channel:
+            await self.layer.group_send('session', {'type': 'once'})
+
+            self.assertEqual((await asyncio.wait_for(self.layer.receive(channel), 1))['type'], 'once')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.layer.receive(channel), 0.3)
+
+    async def test_discarded_member_gets_nothing(self):
+        async with self.member('session') as channel:
+            await self.layer.group_discard('session', channel)
+            await self.layer.group_send('session', {'type': 'late'})
+
+            self.assertNotIn(channel, self.layer.local_queues)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.layer.receive(channel), 0.3)
+
+
+class FakeBackend(SSHBackend):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.connects = 0
+
+    async def connect(self, host, username, password, port, pkey, passphrase):
+        self.connects += 1
+        await asyncio.sleep(0.05)
+        if self.fail:
+            raise ConnectionRefusedError(host)
+        return object()
+
+    async def open_channel(self, connection):
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def send(self, channel, data):
+        pass
+
+    async def recv(self, channel, size):
+        return b''
+
+    async def resize(self, channel, width, height):
+        pass
+
+    def is_active(self, channel):
+        return True
+
+    def is_connection_active(self, connection):
+        return True
+
+    def close_channel(self, channel):
+        pass
+
+    def close(self, connection):
+        pass
+
+
+class ScriptedBackend(FakeBackend):
+    ''' Hands out `chunks` one read at a time, an exception in the list is raised instead '''
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = list(chunks)
+
+    async def recv(self, channel, size):
+        await asyncio.sleep(0)
+        chunk = self.chunks.pop(0) if self.chunks else b''
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+
+def reset_ssh_module():
+    for handle in SSHModule.pool_expiry.values():
+        handle.cancel()
+    for registry in (SSHModule.pool, SSHModule.pool_refs, SSHModule.pool_expiry, SSHModule.pool_keys,
+                     SSHModule.active_connections):
+        registry.clear()
+
+
+class SSHModuleTestCase(SimpleTestCase):
+    GROUP = 1
+    ARGS = ('host', 'user', 'password')
+
+    def tearDown(self):
+        reset_ssh_module()
+
+    async def stop_monitor(self):
+        if SSHModule.monitor is not None:
+            SSHModule.monitor.cancel()
+            SSHModule.monitor = None
+
+
+class SSHModuleReaderTests(SSHModuleTestCase):
+    async def pump(self, chunks, callback):
+        closed = asyncio.Event()
+
+        async def on_close():
+            closed.set()
+
+        with mock.patch.object(SSHModule, 'backend', ScriptedBackend(chunks)):
+            await SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS)
+            SSHModule.start_reader(self.GROUP, callback, on_close)
+            await asyncio.wait_for(closed.wait(), 1)
+        await self.stop_monitor()
+
+    async def test_failing_callback_skips_the_chunk(self):
+        received = []
+
+        async def callback(data):
+            if data == b'bad':
+                raise RuntimeError('flush failed')
+            received.append(data)
+
+        with self.assertLogs('terminal.ssh', 'ERROR'):
+            await self.pump([b'one', b'bad', b'two'], callback)
+        self.assertEqual(received, [b'one', b'two'])
+
+    async def test_failing_read_drops_the_group(self):
+        async def callback(data):
+            pass
+
+        with self.assertLogs('terminal.ssh', 'ERROR'):
+            await self.pump([b'one', OSError('connection reset')], callback)
+        self.assertNotIn(self.GROUP, SSHModule.instances)
+        self.assertNotIn(self.GROUP, SSHModule.readers)
+
+
+class AsyncSSHModuleTests(SSHModuleTestCase):
+    ''' SSHModule on the asyncssh backend against the in-process echo server of `benchmark_ssh` '''
+
+    def setUp(self):
+        if asyncssh is None:
+            self.skipTest('asyncssh is not installed')
+
+    @asynccontextmanager
+    async def server(self):
+        server = await asyncssh.create_server(EchoServer, '127.0.0.1', 0, process_factory=echo_shell, encoding=None,
+                                              server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')])
+        backend = AsyncSSHBackend()
+        with mock.patch.object(SSHModule, 'backend', backend):
+            try:
+                yield server.sockets[0].getsockname()[1], backend
+            finally:
+                for group_name in list(SSHModule.active_connections):
+                    while group_name in SSHModule.active_connections:
+                        SSHModule.disconnect(group_name)
+                for ssh in list(SSHModule.pool.values()):
+                    backend.close(ssh)
+                await self.stop_monitor()
+                server.close()
+                await server.wait_closed()
+
+    async def test_second_tab_reuses_the_connection(self):
+        async with self.server() as (port, backend):
+            await SSHModule.connect_or_create_instance(1, '127.0.0.1', 'user', 'password', port=port)
+            await SSHModule.connect_or_create_instance(2, '127.0.0.1', 'user', 'password', port=port)
+
+            self.assertIs(SSHModule.instances[1], SSHModule.instances[2])
+            await SSHModule.send(2, b'ping')
+            self.assertEqual(await asyncio.wait_for(SSHModule.read(2), 2), b'ping')
+
+    async def test_closed_connection_is_reported_inactive(self):
+        async with self.server() as (port, backend):
+            await SSHModule.connect_or_create_instance(1, '127.0.0.1', 'user', 'password', port=port)
+            ssh = SSHModule.instances[1]
+            self.assertTrue(backend.is_connection_active(ssh))
+
+            ssh.close()
+            await ssh.wait_closed()
+            await asyncio.sleep(0)
+            self.assertFalse(backend.is_connection_active(ssh))
+
+
+class SSHModuleConnectTests(SSHModuleTestCase):
+    async def test_concurrent_joins_share_one_connection(self):
+        backend = FakeBackend()
+        with mock.patch.object(SSHModule, 'backend', backend):
+            await asyncio.gather(*(SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS) for _ in range(3)))
+            key = SSHModule.pool_keys[self.GROUP]
+
+            self.assertEqual(backend.connects, 1)
+            self.assertEqual(SSHModule.active_connections[self.GROUP], 3)
+            self.assertEqual(SSHModule.pool_refs[key], 1)
+            self.assertEqual(SSHModule.connect_locks, {})
+            self.assertEqual(SSHModule.pool_locks, {})
+
+            for _ in range(3):
+                SSHModule.disconnect(self.GROUP)
+            self.assertNotIn(self.GROUP, SSHModule.instances)
+            self.assertEqual(SSHModule.pool_refs[key], 0)
+            await self.stop_monitor()
+
+    async def test_viewers_stay_counted_across_a_drop(self):
+        with mock.patch.object(SSHModule, 'backend', FakeBackend()):
+            for _ in range(3):
+                await SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS)
+            await SSHModule._SSHModule__drop(self.GROUP)
+            self.assertNotIn(self.GROUP, SSHModule.instances)
+            self.assertEqual(SSHModule.active_connections[self.GROUP], 3)
+
+            await SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS, join=False)
+            SSHModule.disconnect(self.GROUP)
+
+            self.assertIn(self.GROUP, SSHModule.instances)
+            self.assertEqual(SSHModule.active_connections[self.GROUP], 2)
+            for _ in range(2):
+                SSHModule.disconnect(self.GROUP)
+            self.assertNotIn(self.GROUP, SSHModule.instances)
+            self.assertNotIn(self.GROUP, SSHModule.active_connections)
+            await self.stop_monitor()
+
+    async def test_disconnect_from_another_thread_runs_on_the_loop(self):
+        with mock.patch.object(SSHModule, 'backend', ScriptedBackend([])):
+            await SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS)
+            # A reader that never ends, like one waiting on a quiet channel
+            SSHModule.readers[self.GROUP] = asyncio.ensure_future(asyncio.Event().wait())
+
+            errors = []
+            thread = threading.Thread(target=lambda: self.call(SSHModule.disconnect, errors, self.GROUP))
+            thread.start()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            await asyncio.sleep(0)
+
+            self.assertEqual(errors, [])
+            self.assertNotIn(self.GROUP, SSHModule.instances)
+            self.assertNotIn(self.GROUP, SSHModule.readers)
+            await self.stop_monitor()
+
+    @staticmethod
+    def call(function, errors, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            errors.append(e)
+
+    async def test_failed_connect_leaves_no_lock_behind(self):
+        with mock.patch.object(SSHModule, 'backend', FakeBackend(fail=True)):
+            results = await asyncio.gather(*(SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS)
+                                             for _ in range(2)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ConnectionRefusedError) for result in results))
+        self.assertNotIn(self.GROUP, SSHModule.instances)
+        self.assertEqual(SSHModule.connect_locks, {})
+        self.assertEqual(SSHModule.pool_locks, {})
+
+
+class SSHModuleResizeTests(SSHModuleTestCase):
+    def tearDown(self):
+        for registry in (SSHModule.terminal_sizes, SSHModule.size_counts, SSHModule.min_sizes):
+            registry.pop(self.GROUP, None)
+        super().tearDown()
+
+    def test_identical_sizes_stay_counted(self):
+        SSHModule.set_terminal_size(self.GROUP, 'a', 80, 24)
+        SSHModule.set_terminal_size(self.GROUP, 'b', 80, 24)
+
+        SSHModule.del_terminal_size(self.GROUP, 'a')
+        self.assertEqual(SSHModule.get_terminal_size(self.GROUP), (80, 24))
+        SSHModule.del_terminal_size(self.GROUP, 'b')
+        self.assertIsNone(SSHModule.get_terminal_size(self.GROUP))
+
+    def test_minimum_moves_up_when_its_last_holder_leaves(self):
+        SSHModule.set_terminal_size(self.GROUP, 'a', 100, 40)
+        SSHModule.set_terminal_size(self.GROUP, 'b', 80, 30)
+        SSHModule.set_terminal_size(self.GROUP, 'c', 80, 50)
+        self.assertEqual(SSHModule.get_terminal_size(self.GROUP), (80, 30))
+
+        SSHModule.del_terminal_size(self.GROUP, 'b')
+        self.assertEqual(SSHModule.get_terminal_size(self.GROUP), (80, 40))
+        SSHModule.del_terminal_size(self.GROUP, 'c')
+        self.assertEqual(SSHModule.get_terminal_size(self.GROUP), (100, 40))
+
+    async def test_resize_storm_resizes_the_pty_once(self):
+        backend = FakeBackend()
+        backend.resize = mock.AsyncMock()
+        with mock.patch.object(SSHModule, 'backend', backend), mock.patch('terminal.ssh.SSH_RESIZE_DEBOUNCE', 0.01):
+            await SSHModule.connect_or_create_instance(self.GROUP, *self.ARGS)
+            for width in range(120, 90, -1):
+                SSHModule.set_terminal_size(self.GROUP, 'a', width, 40)
+                SSHModule.set_terminal_size(self.GROUP, 'b', width + 10, 30)
+            await asyncio.sleep(0.05)
+
+            backend.resize.assert_awaited_once_with(mock.ANY, 91, 30)
+
+            # Sizes above the minimum leave the PTY alone
+            SSHModule.set_terminal_size(self.GROUP, 'b', 150, 30)
+            await asyncio.sleep(0.05)
+            self.assertEqual(backend.resize.await_count, 1)
+
+            SSHModule.disconnect(self.GROUP)
+            await self.stop_monitor()
+
+
+class ViewerOutboxTests(SimpleTestCase):
+    def outbox(self, policy, **limits):
+        async def write(kind, payload, offset):
+            pass
+        return ViewerOutbox('viewer', write, group='1', policy=policy, **limits)
+
+    def test_coalesce_keeps_size_in_step_with_the_queue(self):
+        outbox = self.outbox(ViewerOutbox.COALESCE, max_messages=2)
+        for offset in range(1, 4):
+            self.assertTrue(outbox.put('output', output_frame(b'x', offset), offset))
+
+        self.assertEqual([(kind, offset) for kind, _, offset in outbox.queue], [('output', 3)])
+        self.assertEqual(outbox.size, sum(len(payload) for _, payload, _ in outbox.queue))
+        self.assertEqual(outbox.overflows, 1)
+
+    def test_resync_drops_output_but_keeps_messages(self):
+        outbox = self.outbox(ViewerOutbox.RESYNC, max_messages=2)
+        outbox.put('output', output_frame(b'a', 1), 1)
+        outbox.put('text', '{}')
+        outbox.put('output', output_frame(b'b', 2), 2)
+
+        self.assertEqual([kind for kind, _, _ in outbox.queue], ['text', 'resync'])
+        self.assertEqual(outbox.size, 2)
+
+    def test_coalesce_falls_back_to_resync_when_still_too_big(self):
+        outbox = self.outbox(ViewerOutbox.COALESCE, max_bytes=32)
+        outbox.put('output', output_frame(b'a' * 20, 20), 20)
+        outbox.put('output', output_frame(b'b' * 20, 40), 40)
+
+        self.assertEqual([kind for kind, _, _ in outbox.queue], ['resync'])
+        self.assertEqual(outbox.size, 0)
+
+    def test_messages_alone_over_the_limit_disconnect(self):
+        for policy in (ViewerOutbox.COALESCE, ViewerOutbox.RESYNC):
+            outbox = self.outbox(policy, max_messages=3)
+            results = [outbox.put('text', '{}') for _ in range(5)]
+
+            self.assertEqual(results, [True, True, True, False, False])
+
+    def test_viewer_without_scrollback_is_never_sent_a_resync(self):
+        outbox = self.outbox(ViewerOutbox.RESYNC, max_bytes=8)
+        outbox.resync = False
+
+        self.assertTrue(outbox.put('text', 'a' * 8))
+        self.assertFalse(outbox.put('text', 'b' * 8))
+        self.assertNotIn('resync', [kind for kind, _, _ in outbox.queue])
+
+    def test_disconnect_reports_the_overflow(self):
+        outbox = self.outbox(ViewerOutbox.DISCONNECT, max_messages=1)
+        self.assertTrue(outbox.put('text', '{}'))
+        self.assertFalse(outbox.put('text', '{}'))
+
+    async def test_released_frame_is_written_before_the_queue(self):
+        written = []
+
+        async def write(kind, payload, offset):
+            written.append(kind)
+
+        outbox = ViewerOutbox('viewer', write)
+        outbox.start()
+        outbox.pause()
+        outbox.put('output', output_frame(b'a', 1), 1)
+        await asyncio.sleep(0.01)
+        self.assertEqual(written, [])
+
+        outbox.release('snapshot', '{}', 0)
+        await asyncio.sleep(0.01)
+        outbox.stop()
+        self.assertEqual(written, ['snapshot', 'output'])
+
+    def test_queue_depth_is_reported_per_session(self):
+        first, second = self.outbox(ViewerOutbox.COALESCE), self.outbox(ViewerOutbox.COALESCE)
+        second.name = 'other'
+        first.put('text', 'a' * 10)
+        second.put('text', 'b' * 30)
+        second.put('text', 'c' * 5)
+
+        with mock.patch.dict(ViewerOutbox.instances, {'viewer': first, 'other': second}, clear=True):
+            families = {name: dict(samples) for name, _, _, samples in Metrics.collect()}
+
+        session = (('session', '1'),)
+        self.assertEqual(families['webterminal_viewer_outboxes'][session], 2)
+        self.assertEqual(families['webterminal_viewer_queued_bytes'][session], 45)
+        self.assertEqual(families['webterminal_viewer_queued_bytes_max'][session], 35)
+        self.assertEqual(families['webterminal_viewer_queued_messages_max'][session], 2)
+
+
+class SessionDataChangedTests(TestCase):
+    def setUp(self):
+        user = AccountData.objects.create_user('master', 'password')
+        self.note = NotesData.objects.create(session_master=user)
+
+    def test_note_edits_do_not_invalidate_viewers(self):
+        with mock.patch('terminal.signals.get_channel_layer') as get_channel_layer, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.note.set_content({'ops': [{'insert': 'text'}]})
+
+        get_channel_layer.assert_not_called()
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.content, {'ops': [{'insert': 'text'}]})
+
+    def test_invalidation_waits_for_commit_and_survives_layer_errors(self):
+        with mock.patch('terminal.signals.get_channel_layer', side_effect=ConnectionError('redis down')) as \
+                get_channel_layer:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.note.update_obj({'name': 'Renamed'})
+            get_channel_layer.assert_not_called()
+
+            with self.assertLogs('terminal.signals', 'ERROR'):
+                for callback in callbacks:
+                    callback()
+            get_channel_layer.assert_called_once()
+
+
+class KeepaliveTransport:
+    ''' Transport whose peer answers keepalives only while `responsive` is set, like paramiko's it gives up
+    waiting once closed '''
+
+    def __init__(self, responsive=True):
+        self.responsive = responsive
+        self.active = True
+        self.requests = 0
+
+    def is_active(self):
+        return self.active
+
+    def global_request(self, kind, data=None, wait=True):
+        self.requests += 1
+        while self.active and not self.responsive:
+            threading.Event().wait(0.01)
+        return None
+
+    def close(self):
+        self.active = False
+
+
+@mock.patch('terminal.ssh_backends.SSH_KEEPALIVE_COUNT_MAX', 3)
+@mock.patch('terminal.ssh_backends.SSH_KEEPALIVE_INTERVAL', 0.02)
+class ParamikoKeepaliveTests(SimpleTestCase):
+    async def keepalive(self, transport, duration):
+        task = asyncio.ensure_future(ParamikoBackend()._ParamikoBackend__keepalive(transport))
+        await asyncio.wait((task,), timeout=duration)
+        transport.close()
+        await asyncio.wait_for(task, 1)
+
+    async def test_answering_peer_stays_connected(self):
+        transport = KeepaliveTransport()
+        await self.keepalive(transport, 0.3)
+        self.assertGreater(transport.requests, 3)
+
+    async def test_queued_keepalive_does_not_count_as_missed(self):
+        # The only thread is held by a silent peer for three intervals, the healthy one waits for it.
+        silent, healthy = KeepaliveTransport(responsive=False), KeepaliveTransport()
+        with mock.patch('terminal.ssh_backends.keepalive_executor', ThreadPoolExecutor(1)):
+            backend = ParamikoBackend()
+            tasks = [asyncio.ensure_future(backend._ParamikoBackend__keepalive(transport))
+                     for transport in (silent, healthy)]
+            await asyncio.wait_for(tasks[0], 1)
+
+            self.assertFalse(silent.active)
+            self.assertTrue(healthy.active)
+            healthy.close()
+            await asyncio.wait_for(tasks[1], 1)
+
+    async def test_silent_peer_is_closed_after_count_max_intervals(self):
+        transport = KeepaliveTransport(responsive=False)
+        task = asyncio.ensure_future(ParamikoBackend()._ParamikoBackend__keepalive(transport))
+
+        await asyncio.wait_for(task, 1)
+        self.assertFalse(transport.active)
+        self.assertEqual(transport.requests, 1)
+
+
+class WindowChannel:
+    ''' Non-blocking channel taking at most `window` bytes until the remote host opens it again '''
+
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.out_buffer_cv = threading.Condition(self.lock)
+        self.out_window_size = window
+        self.closed = False
+        self.received = b''
+
+    def send(self, data):
+        with self.lock:
+            if not self.out_window_size:
+                raise socket.timeout()
+            sent = data[:self.out_window_size]
+            self.out_window_size -= len(sent)
+            self.received += sent
+            return len(sent)
+
+    def open_window(self, size):
+        with self.lock:
+            self.out_window_size += size
+            self.out_buffer_cv.notify_all()
+
+
+class ParamikoSendTests(SimpleTestCase):
+    send_all = staticmethod(ParamikoBackend._ParamikoBackend__send_all)
+
+    def test_send_waits_for_the_window(self):
+        channel = WindowChannel(4)
+        threading.Timer(0.05, channel.open_window, (100,)).start()
+
+        self.send_all(channel, b'0123456789')
+        self.assertEqual(channel.received, b'0123456789')
+
+    @mock.patch('terminal.ssh_backends.SSH_SEND_TIMEOUT', 0.05)
+    def test_send_gives_up_on_a_window_that_stays_closed(self):
+        channel = WindowChannel(4)
+
+        with self.assertRaises(socket.timeout):
+            self.send_all(channel, b'0123456789')
+        self.assertEqual(channel.received, b'0123')
+
+
+class TerminalScreenTests(SimpleTestCase):
+    def setUp(self):
+        self.ring = RingBuffer(capacity=64)
+        self.screen = TerminalScreen(self.ring, lambda data: data.decode(), columns=20, lines=4)
+
+    async def test_output_is_parsed_off_the_event_loop_when_needed(self):
+        threads = []
+        feed = self.screen.stream.feed
+        self.screen.stream.feed = lambda text: threads.append(threading.current_thread()) or feed(text)
+
+        self.ring.append(b'hello\r\n')
+        self.ring.append(b'world')
+        self.assertEqual(threads, [])
+
+        self.assertEqual(await self.screen.snapshot(), ('hello\r\nworld\x1b[6G', 12))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.assertEqual(self.screen.backlog, 0)
+
+    async def test_resize_lays_out_earlier_output_first(self):
+        self.ring.append(b'x' * 30)
+        await self.screen.resize(40, 4)
+
+        self.assertEqual(await self.screen.snapshot(), ('x' * 20 + '\r\n' + 'x' * 10 + '\x1b[11G', 30))
+
+    async def test_snapshot_reports_the_offset_it_was_fed_to(self):
+        feed = self.screen.stream.feed
+        self.screen.stream.feed = lambda text: threading.Event().wait(0.05) or feed(text)
+        self.ring.append(b'EARLY')
+
+        snapshot = asyncio.ensure_future(self.screen.snapshot())
+        await asyncio.sleep(0.01)
+        self.ring.append(b'LATE')
+
+        self.assertEqual(await snapshot, ('EARLY\x1b[6G', 5))
+        self.assertEqual(self.screen.backlog, 4)
+
+
+class TranscriptStripperTests(SimpleTestCase):
+    def strip(self, *chunks):
+        stripper = TranscriptStripper(0)
+        return [stripper.strip(chunk) for chunk in chunks]
+
+    def test_escape_split_between_chunks(self):
+        self.assertEqual(self.strip(b'ls\x1b[01;3', b'4mdir\x1b[0m'), ['ls', 'dir'])
+        self.assertEqual(self.strip(b'\x1b]0;user@host:', b'~\x07$ '), ['', '$ '])
+
+    def test_character_split_between_chunks(self):
+        self.assertEqual(self.strip('caf\u00e9'.encode()[:-1], 'caf\u00e9'.encode()[-1:]), ['caf', '\u00e9'])
+
+    def test_chunk_out_of_sequence_starts_over(self):
+        TranscriptStripper.get('1', 0).strip(b'\x1b[1')
+        self.assertEqual(TranscriptStripper.get('1', 100).strip(b'2mtext'), '2mtext')
+        TranscriptStripper.discard('1')
+
+
+@mock.patch('terminal.search.SEARCH_NOTE_INDEX_DELAY', 0.05)
+class NoteIndexerTests(SimpleTestCase):
+    async def test_edits_in_a_row_index_once(self):
+        with mock.patch.object(NoteIndexer, 'index') as index:
+            for _ in range(3):
+                NoteIndexer.schedule(7)
+                await asyncio.sleep(0.01)
+            index.assert_not_called()
+
+            await asyncio.sleep(0.1)
+        index.assert_called_once_with(7)
+        self.assertEqual(NoteIndexer.timers, {})
+
+
+class RingBufferTests(SimpleTestCase):
+    def test_wraps_around_and_keeps_the_latest_output(self):
+        ring = RingBuffer(start=100, capacity=8)
+        self.assertEqual(ring.append(b'abcdef'), 106)
+        self.assertEqual(ring.append(b'ghij'), 110)
+
+        self.assertEqual((ring.start, ring.end), (102, 110))
+        self.assertEqual(ring.since(104), b'efghij')
+        self.assertIsNone(ring.since(101))
+
+    def test_pending_output_stays_until_committed(self):
+        ring = RingBuffer(capacity=8)
+        ring.append(b'abc')
+        data, end = ring.peek_pending()
+        ring.append(b'de')
+
+        self.assertEqual((data, end, ring.pending), (b'abc', 3, 5))
+        ring.commit(end)
+        self.assertEqual(ring.peek_pending(), (b'de', 5))
+
+
+class TranscriptFlushTests(TestCase):
+    def setUp(self):
+        user = AccountData.objects.create_user('master', 'password')
+        self.session = SSHData.objects.create(session_master=user)
+        self.ring = RingBuffer.create(self.session.pk)
+        self.addCleanup(RingBuffer.discard, self.session.pk)
+        self.addCleanup(reset_ssh_module)
+
+    def flush(self):
+        return async_to_sync(SSHData._SSHData__update_content)(self.session.pk)
+
+    def pump(self, chunks, store_error=None):
+        received = []
+
+        async def run():
+            closed = asyncio.Event()
+
+            async def callback(data, offset):
+                received.append(data)
+
+            async def on_close():
+                closed.set()
+
+            with mock.patch.object(SSHModule, 'backend', ScriptedBackend(chunks)):
+                await SSHModule.connect_or_create_instance(self.session.pk, 'host', 'user', 'password')
+                await self.session.start_output(callback, on_close)
+                await asyncio.wait_for(closed.wait(), 1)
+            if SSHModule.monitor is not None:
+                SSHModule.monitor.cancel()
+                SSHModule.monitor = None
+
+        with mock.patch('terminal.models.transcript_store.append_async', side_effect=store_error), \
+                mock.patch.object(SSHData, 'BUFFER_SIZE_LIMIT', 4):
+            async_to_sync(run)()
+        return received
+
+    def test_failing_flushes_do_not_hold_back_live_output(self):
+        with self.assertLogs('terminal.models', 'ERROR'):
+            received = self.pump([b'one', b'two', b'three'], store_error=OSError('database is locked'))
+
+        self.assertEqual(received, [b'one', b'two', b'three'])
+        self.assertEqual(self.ring.pending, 11)
+
+    def test_full_ring_waits_for_the_transcript(self):
+        self.ring = RingBuffer.instances[self.session.pk] = RingBuffer(capacity=8)
+        attempts = []
+
+        async def append(session_id, seq, offset, payload):
+            attempts.append(payload)
+            if len(attempts) == 1:
+                raise OSError('disk full')
+
+        with mock.patch.object(SSHData, 'FLUSH_RETRY_DELAY', 0.01), self.assertLogs('terminal.models', 'ERROR'):
+            received = self.pump([b'abcdef', b'ghijk'], store_error=append)
+
+        self.assertEqual(received, [b'abcdef', b'ghijk'])
+        self.assertEqual(attempts, [b'abcdef', b'abcdef', b'ghijk'])
+        self.assertEqual((self.ring.pending, self.session.get_transcript_size()), (0, 11))
+
+    def test_failed_write_keeps_the_output_pending(self):
+        self.ring.append(b'output')
+        with mock.patch('terminal.models.transcript_store.append_async', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.flush()
+
+        self.assertEqual(self.ring.pending, 6)
+        self.assertEqual(self.session.get_transcript_size(), 0)
+
+        self.flush()
+        self.assertEqual(self.ring.pending, 0)
+        self.assertEqual(self.session.read_transcript(), ('output', 0, 6))
+
+
+class FileTranscriptStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = FileTranscriptStore(directory.name, level=1)
+        self.paths = Path(directory.name) / '1.frames', Path(directory.name) / '1.index'
+
+    def append(self, *payloads):
+        offset = 0
+        for seq, payload in enumerate(payloads):
+            self.store.append(1, seq, offset, payload)
+            offset += len(payload)
+
+    def test_ranges_span_frame_boundaries(self):
+        self.append(b'hello ', b'wide ', b'world')
+
+        self.assertEqual(b''.join(self.store.iter_transcript(1)), b'hello wide world')
+        self.assertEqual(self.store.read_range(1, 0, 16), b'hello wide world')
+        self.assertEqual(self.store.read_range(1, 4, 13), b'o wide wo')
+
+    def test_read_from_the_middle_of_a_frame(self):
+        self.append(b'hello ', b'wide ', b'world')
+
+        self.assertEqual(list(self.store.iter_transcript(1, 8)), [b'de ', b'world'])
+        self.assertEqual(list(self.store.iter_transcript(1, 11)), [b'world'])
+        self.assertEqual(list(self.store.iter_transcript(1, 16)), [])
+
+    def test_frames_indexed_out_of_order(self):
+        self.store.append(1, 1, 6, b'world')
+        self.store.append(1, 0, 0, b'hello ')
+
+        self.assertEqual(b''.join(self.store.iter_transcript(1)), b'hello world')
+        self.assertEqual(self.store.read_range(1, 3, 8), b'lo wo')
+
+    def test_missing_index_reads_as_empty(self):
+        self.assertEqual(list(self.store.iter_transcript(1)), [])
+
+        self.append(b'hello')
+        self.paths[1].unlink()
+        self.assertEqual(self.store.read_range(1, 0, 5), b'')
+
+    def test_delete_removes_both_files(self):
+        self.append(b'hello')
+        self.store.delete(1)
+
+        self.assertFalse(any(path.exists() for path in self.paths))
+        self.assertEqual(list(self.store.iter_transcript(1)), [])
+        self.store.delete(1)
+
+
+class SSHGatewayTests(SimpleTestCase):
+    def viewer(self):
+        consumer = SessionCosumer()
+        consumer.outbox = ViewerOutbox('viewer', mock.AsyncMock())
+        consumer.outbox.pause()
+        consumer.outbox.put('output', output_frame(b'abc', 3), 3)
+        return consumer
+
+    async def test_dispatched_events_are_referenced_until_handled(self):
+        handled = asyncio.Event()
+        with mock.patch.object(SSHGateway, 'handle_in_order', side_effect=lambda event: handled.wait()):
+            await SSHGatewayConsumer().dispatch({'type': 'ssh.input', 'session': 1})
+            task, = SSHGatewayConsumer.tasks
+            handled.set()
+            await task
+
+        self.assertEqual(SSHGatewayConsumer.tasks, set())
+
+    async def test_open_of_a_deleted_session_is_answered(self):
+        with mock.patch.object(SSHGateway, 'get_session', mock.AsyncMock(return_value=None)), \
+                mock.patch.object(SSHGateway, 'reply', mock.AsyncMock()) as reply:
+            await SSHGateway.ssh_open({'type': 'ssh.open', 'session': 1, 'reply_to': 'viewer', 'offset': None})
+
+        reply.assert_awaited_once_with('viewer', kind='error', content='The session no longer exists')
+
+    async def test_gateway_error_releases_the_viewer(self):
+        consumer = self.viewer()
+        consumer.sync_timeout = mock.Mock()
+        timeout = consumer.sync_timeout
+        await consumer.gateway_sync({'type': 'gateway.sync', 'kind': 'error', 'content': 'gone'})
+
+        timeout.cancel.assert_called_once_with()
+        self.assertFalse(consumer.outbox.paused)
+        self.assertEqual([kind for kind, _, _ in consumer.outbox.queue], ['text', 'output'])
+
+    async def test_unanswered_open_asks_the_viewer_to_resync(self):
+        consumer = self.viewer()
+        consumer._SessionCosumer__sync_timed_out()
+
+        self.assertFalse(consumer.outbox.paused)
+        self.assertEqual([kind for kind, _, _ in consumer.outbox.queue], ['text', 'resync', 'output'])
+
+
+class ViewerWriteTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = SessionCosumer()
+        self.consumer.binary = True
+        self.consumer.send = mock.AsyncMock()
+
+    def sent(self):
+        return [frame_payload(call.kwargs['bytes_data']) for call in self.consumer.send.await_args_list
+                if 'bytes_data' in call.kwargs]
+
+    async def test_output_already_in_the_snapshot_is_trimmed(self):
+        await self.consumer.write_frame('snapshot', '{}', 10)
+        await self.consumer.write_frame('output', output_frame(b'abcdefgh', 14), 14)
+        await self.consumer.write_frame('output', output_frame(b'ij', 12), 12)
+        await self.consumer.write_frame('output', output_frame(b'klm', 17), 17)
+
+        self.assertEqual(self.sent(), [b'efgh', b'klm'])
+        self.assertEqual(self.consumer.sent_offset, 17)
+
+    async def test_untrimmed_frames_are_sent_as_shared(self):
+        frame = output_frame(b'abc', 3)
+        await self.consumer.write_frame('output', frame, 3)
+
+        self.assertIs(self.consumer.send.await_args.kwargs['bytes_data'], frame)
@@ -0,0 +1,118 @@
+import itertools
+import random
+import time
+from bisect import bisect_left
+from terminal.metrics import Metrics
+from web.settings import LATENCY_TRACE_SAMPLE_RATE
+
+
+class LatencyTracer:
+    ''' Sampled keystroke-to-echo tracing.
+
+    A sampled input batch takes a trace (`id`, the viewer that typed it and when it was received) along
+    with its `ssh.input` event. The gateway stamps it when the input reaches it, when it was written to the
+    SSH channel and when the next output was read, then hands it over with the first output broadcast that
+    follows. That viewer stamps the delivery and the WebSocket write, records the stages and asks the
+    browser for its own round trip. Stamps are wall clock times so they compare across the web workers
+    and the gateway of one host.
+    '''
+    METRIC = 'webterminal_latency_seconds'
+    # stage: (from stamp, to stamp)
+    STAGES = {
+        'receive': ('received', 'gateway'),
+        'send': ('gateway', 'written'),
+        'remote': ('written', 'read'),
+        'process': ('read', 'published'),
+        'broadcast': ('published', 'delivered'),
+        'outbox': ('delivered', 'sent'),
+        'server': ('received', 'sent'),
+    }
+    CLIENT_STAGES = ('browser', 'network', 'round_trip')
+    # A trace without output (e.g. a typed password) makes way for the next one after this many seconds
+    TIMEOUT = 5
+
+    ids = itertools.count(1)
+    # Gateway side: the trace waiting for output, one per session
+    pending = {}
+
+    @classmethod
+    def sample(cls, viewer):
+        if LATENCY_TRACE_SAMPLE_RATE <= 0 or random.random() >= LATENCY_TRACE_SAMPLE_RATE:
+            return None
+        return {'id': next(cls.ids), 'viewer': viewer, 'received': time.time()}
+
+    @classmethod
+    def begin(cls, session_id, trace):
+        current = cls.pending.get(session_id)
+        if current is None or time.time() - current['gateway'] > cls.TIMEOUT:
+            trace['gateway'] = time.time()
+            cls.pending[session_id] = trace
+
+    @classmethod
+    def mark(cls, session_id, stamp, after):
+        trace = cls.pending.get(session_id)
+        if trace is not None and after in trace and stamp not in trace:
+            trace[stamp] = time.time()
+
+    @classmethod
+    def take(cls, session_id):
+        ''' The pending trace of a session once its output was read, stamped as published '''
+        trace = cls.pending.get(session_id)
+        if trace is None or 'read' not in trace:
+            return None
+
+        del cls.pending[session_id]
+        trace['published'] = time.time()
+        return trace
+
+    @classmethod
+    def discard(cls, session_id):
+        cls.pending.pop(session_id, None)
+
+    @classmethod
+    def record(cls, trace) -> float:
+        ''' Record the server side stages of a finished trace and return the time it spent on the server '''
+        for stage, (start, end) in cls.STAGES.items():
+            if start in trace and end in trace:
+                Metrics.observe(cls.METRIC, max(trace[end] - trace[start], 0), stage=stage)
+        return trace['sent'] - trace['received']
+
+    @classmethod
+    def record_client(cls, server, round_trip, batch):
+        ''' Stages measured by the browser, in milliseconds: input batching and the round trip it saw '''
+        try:
+            round_trip, batch = float(round_trip) / 1000, float(batch) / 1000
+        except (TypeError, ValueError):
+            return
+        if not (0 <= round_trip < 60 and 0 <= batch < 60):
+            return
+
+        Metrics.observe(cls.METRIC, batch, stage='browser')
+        Metrics.observe(cls.METRIC, max(round_trip - server, 0), stage='network')
+        Metrics.observe(cls.METRIC, round_trip, stage='round_trip')
+
+    @classmethod
+    def summary(cls):
+        ''' Count, mean and bucket upper bounds of the 50th, 90th and 99th percentile of every stage '''
+        histograms = {labels[0][1]: histogram for (name, labels), histogram in list(Metrics.histograms.items())
+                      if name == cls.METRIC}
+
+        stages = {}
+        for stage in (*cls.STAGES, *cls.CLIENT_STAGES):
+            histogram = histograms.get(stage)
+            if histogram is None:
+                continue
+
+            counts = list(itertools.accumulate(histogram[:-1]))
+            count = counts[-1]
+            stages[stage] = {
+                'count': count,
+                'mean': histogram[-1] / count,
+                **{f'p{round(q * 100)}': cls.__bound(counts, q * count) for q in (0.5, 0.9, 0.99)},
+            }
+        return stages
+
+    @staticmethod
+    def __bound(counts, rank):
+        index = bisect_left(counts, rank)
+        return Metrics.BUCKETS[index] if index < len(Metrics.BUCKETS) else None
@@ -0,0 +1,142 @@
+import asyncio
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from asgiref.sync import sync_to_async
+from django.utils.module_loading import import_string
+from terminal.executors import transcript_executor
+from web.settings import TRANSCRIPT_STORE, TRANSCRIPT_DIR, TRANSCRIPT_COMPRESSION_LEVEL
+
+
+class TranscriptStore(ABC):
+    ''' Where flushed SSH output is kept. Offsets are byte positions in the raw session output. '''
+
+    @abstractmethod
+    def append(self, session_id, seq, offset, payload: bytes):
+        ...
+
+    @abstractmethod
+    def iter_transcript(self, session_id, start_offset=0):
+        ''' Yield the raw transcript from `start_offset` on, in order. '''
+
+    @abstractmethod
+    def delete(self, session_id):
+        ...
+
+    async def append_async(self, session_id, seq, offset, payload: bytes):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(transcript_executor, self.append, session_id, seq, offset, payload)
+
+    def read_range(self, session_id, start_offset, end_offset) -> bytes:
+        parts = []
+        position = start_offset
+
+        for payload in self.iter_transcript(session_id, start_offset):
+            if position >= end_offset:
+                break
+            parts.append(payload[:end_offset - position])
+            position += len(payload)
+
+        return b''.join(parts)
+
+
+class DatabaseTranscriptStore(TranscriptStore):
+    ''' One TranscriptChunk row per flush '''
+
+    def append(self, session_id, seq, offset, payload):
+        from terminal.models import TranscriptChunk
+        TranscriptChunk.objects.create(session_id=session_id, seq=seq, offset=offset, payload=payload)
+
+    async def append_async(self, session_id, seq, offset, payload):
+        await sync_to_async(self.append)(session_id, seq, offset, payload)
+
+    def iter_transcript(self, session_id, start_offset=0):
+        from terminal.models import TranscriptChunk
+        chunks = TranscriptChunk.objects.filter(session_id=session_id).order_by('seq').values_list('offset', 'payload')
+        if start_offset:
+            first_seq = TranscriptChunk.objects.filter(session_id=session_id, offset__lte=start_offset) \
+                .order_by('-seq').values_list('seq', flat=True).first()
+            chunks = chunks.filter(seq__gte=first_seq or 0)
+
+        for offset, payload in chunks.iterator():
+            payload = bytes(payload)
+            if offset + len(payload) <= start_offset:
+                continue
+            yield payload[max(0, start_offset - offset):]
+
+    def delete(self, session_id):
+        # Rows go away with the SSHData row (on_delete=CASCADE).
+        pass
+
+
+class FileTranscriptStore(TranscriptStore):
+    ''' Compressed frames in `<TRANSCRIPT_DIR>/<session>.frames`, one per flush.
+
+    `<session>.index` holds a fixed size record per frame (transcript offset, position in the
+    frames file, compressed and raw length), reads mmap the frames file and only inflate the
+    frames at or after the requested offset.
+    '''
+    RECORD = struct.Struct('<QQII')
+
+    def __init__(self, directory=TRANSCRIPT_DIR, level=TRANSCRIPT_COMPRESSION_LEVEL):
+        self.directory = Path(directory)
+        self.level = level
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+
+    def __paths(self, session_id):
+        return self.directory / f'{session_id}.frames', self.directory / f'{session_id}.index'
+
+    def __lock(self, session_id):
+        with self.locks_guard:
+            return self.locks.setdefault(session_id, threading.Lock())
+
+    def append(self, session_id, seq, offset, payload):
+        frame = zlib.compress(payload, self.level)
+        frames_path, index_path = self.__paths(session_id)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        with self.__lock(session_id):
+            with open(frames_path, 'ab') as frames:
+                position = frames.seek(0, os.SEEK_END)
+                frames.write(frame)
+            with open(index_path, 'ab') as index:
+                index.write(self.RECORD.pack(offset, position, len(frame), len(payload)))
+
+    def __read_index(self, index_path):
+        try:
+            data = index_path.read_bytes()
+        except FileNotFoundError:
+            return []
+
+        # Concurrent flushes may land out of order, the offsets put them back in place.
+        return sorted(self.RECORD.iter_unpack(data[:len(data) - len(data) % self.RECORD.size]))
+
+    def iter_transcript(self, session_id, start_offset=0):
+        frames_path, index_path = self.__paths(session_id)
+        records = self.__read_index(index_path)
+        if not records:
+            return
+
+        first = max(0, bisect.bisect_right([record[0] for record in records], start_offset) - 1)
+
+        with open(frames_path, 'rb') as frames, mmap.mmap(frames.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for offset, position, length, raw_length in records[first:]:
+                if offset + raw_length <= start_offset:
+                    continue
+                payload = zlib.decompress(view[position:position + length])
+                yield payload[max(0, start_offset - offset):]
+
+    def delete(self, session_id):
+        for path in self.__paths(session_id):
+            path.unlink(missing_ok=True)
+        with self.locks_guard:
+            self.locks.pop(session_id, None)
+
+
+transcript_store: TranscriptStore = import_string(TRANSCRIPT_STORE)()
@@ -2,7 +2,7 @@ from django.urls import path
 from  terminal.views import (
     SSHDetailView, NoteDetailView, SSHCreateView,
     TermianlView, LoginView, LogoutView,
-    TerminalCreatView, NoteCreateView, TerminalJoinView
+    TerminalCreatView, NoteCreateView, TerminalJoinView, SearchView, MetricsView
 )
 
 urlpatterns = [
@@ -15,6 +15,8 @@ urlpatterns = [
     path('ssh/create/', SSHCreateView.as_view(), name='ssh.create'),
     path('note/<int:pk>/', NoteDetailView.as_view(), name='note.detail'),
     path('note/create/', NoteCreateView.as_view(), name='note.create'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 
 
     path('login/', LoginView.as_view(), name='login'),
@@ -2,8 +2,11 @@ from typing import Any
 from django.http import HttpRequest
 from django.http.response import HttpResponse as HttpResponse, HttpResponse
 from django.shortcuts import render, redirect
-from django.views.generic import TemplateView, RedirectView
-from terminal.models import SSHData, NotesData, SessionsList, SavedHost, AccountData, BaseData
+from django.views.generic import TemplateView, RedirectView, View
+from terminal.models import SSHData, NotesData, SessionsList, SavedHost, AccountData, BaseData, SearchEntry
+from terminal.search import search_backend
+from terminal.metrics import Metrics
+from terminal.tracing import LatencyTracer
 from terminal.forms import SSHDataForm, ReconnectForm
 from django.urls import reverse, reverse_lazy
 from web.templates import TemplateSession, TemplateCreateSession, decoded_data
@@ -18,9 +21,11 @@ from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import JsonResponse
-from web.settings import COLOR_PALETTE
+from web.settings import COLOR_PALETTE, SEARCH_RESULTS_MAX, METRICS_TOKEN, LATENCY_TRACE_SAMPLE_RATE
 from django.views.decorators.cache import never_cache
 from django.utils.decorators import method_decorator
+from django.utils.crypto import constant_time_compare
+from django.contrib.admin.views.decorators import staff_member_required
 # ----------------------
 #  SSH session handling
 # ----------------------
@@ -204,6 +209,60 @@ class TerminalJoinView(RedirectView):
         return f'{reverse(self.pattern_name)}?select={session.pk}'
 
 
+class SearchView(LoginRequiredMixin, View):
+    ''' Full-text search over the transcripts and notes of the sessions the user has opened or joined '''
+    KINDS = {'sshdata': SearchEntry.SSH, 'notesdata': SearchEntry.NOTE}
+
+    @method_decorator(never_cache)
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return NO_MANDATORY_PARAMS
+
+        try:
+            limit = min(max(int(request.GET.get('limit', 20)), 1), SEARCH_RESULTS_MAX)
+        except ValueError:
+            limit = 20
+
+        sessions = {}
+        scopes = {kind: [] for kind in self.KINDS.values()}
+        for pk, model, object_id, name in SessionsList.objects.filter(user=request.user) \
+                .values_list('pk', 'content_type__model', 'object_id', 'name'):
+            if model in self.KINDS:
+                scopes[self.KINDS[model]].append(object_id)
+                sessions[self.KINDS[model], object_id] = (pk, name)
+
+        results = []
+        for kind, object_id, offset, snippet, created_at in search_backend().search(query, scopes, limit):
+            session, name = sessions[kind, object_id]
+            results.append({'session': session, 'name': name, 'kind': kind, 'offset': offset,
+                            'snippet': snippet, 'created_at': created_at})
+
+        return JsonResponse({'results': results}, status=200)
+
+
+class MetricsView(View):
+    ''' Prometheus scrape endpoint, runs on the event loop so it reads the registries of the serving worker '''
+
+    async def get(self, request, *args, **kwargs):
+        if METRICS_TOKEN is None:
+            return HttpResponse(status=404)
+
+        if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return HttpResponse(status=403)
+
+        return HttpResponse(Metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class LatencyView(View):
+    ''' Keystroke-to-echo latency per stage of the inputs sampled by this worker, in seconds '''
+
+    @method_decorator(never_cache)
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({'sample_rate': LATENCY_TRACE_SAMPLE_RATE, 'stages': LatencyTracer.summary()}, status=200)
+
+
 class LoginView(TemplateView):
     template_name = 'views/login.html'
     extra_context = {'title': 'login'}
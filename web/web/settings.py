@@ -158,15 +158,108 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# LocalFanoutChannelLayer is channels_redis' RedisChannelLayer delivering group messages to viewers
+# connected to the same process in memory, use 'channels_redis.core.RedisChannelLayer' to turn that off.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'terminal.layers.LocalFanoutChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],  # Redis server address
         },
     },
 }
 
+# SSH transport used by SSHModule:
+#  - 'terminal.ssh_backends.ParamikoBackend' (paramiko, blocking calls in the loop executor)
+#  - 'terminal.ssh_backends.AsyncSSHBackend' (asyncssh, native asyncio, requires `asyncssh`)
+SSH_BACKEND = 'terminal.ssh_backends.ParamikoBackend'
+
+# Thread pools used by the paramiko backend: handshakes/channel setup and the data path (send, resize)
+SSH_CONNECT_WORKERS = 8
+SSH_DATA_WORKERS = 16
+
+# Seconds an authenticated SSH connection stays open after its last session closed, so new tabs to the
+# same host/user skip the handshake
+SSH_POOL_IDLE_TIMEOUT = 60
+
+# SSH-level keepalives (seconds) and how often dead transports are looked for and torn down. A transport
+# missing SSH_KEEPALIVE_COUNT_MAX replies in a row is closed. The paramiko backend waits for the replies in
+# SSH_KEEPALIVE_WORKERS threads, one per transport with an outstanding keepalive.
+SSH_KEEPALIVE_INTERVAL = 30
+SSH_KEEPALIVE_COUNT_MAX = 3
+SSH_KEEPALIVE_WORKERS = 32
+
+# Seconds a write waits for the remote host to open its SSH window before the send fails
+SSH_SEND_TIMEOUT = 30
+SSH_HEALTH_CHECK_INTERVAL = 15
+
+# Viewer resizes within this window (seconds) are folded into a single PTY resize
+SSH_RESIZE_DEBOUNCE = 0.1
+
+# Channel prefix of the `runsshgateway` processes owning the SSH connections, each of the
+# SSH_GATEWAY_SHARDS processes (`--shard 0..N-1`) serves the sessions whose id modulo N is its shard.
+# None keeps the connections inside the web worker that accepted the WebSocket.
+# Gateways need a cache shared with the web workers (credentials of unsaved sessions pass through it).
+SSH_GATEWAY_CHANNEL = None
+SSH_GATEWAY_SHARDS = 1
+# Seconds a joining viewer waits for the gateway's snapshot or replay before it is told to resync
+SSH_GATEWAY_SYNC_TIMEOUT = 10
+
+# Parsed private keys are cached for this many seconds, passphrase decryption runs in this many worker processes
+SSH_KEY_CACHE_TTL = 3600
+SSH_KEY_WORKERS = 2
+
+# TERMINAL OUTPUT
+# Output read within this window (seconds) after a broadcast is merged into the next one,
+# a pending batch is sent earlier once it reaches the byte limit.
+OUTPUT_COALESCE_WINDOW = 0.012
+OUTPUT_COALESCE_MAX_BYTES = 16384
+
+# Frames waiting to be written to a single viewer. What happens to a viewer that falls behind:
+# 'coalesce' (merge pending output), 'resync' (drop it and reload scrollback) or 'disconnect'
+VIEWER_QUEUE_MAX_MESSAGES = 256
+VIEWER_QUEUE_MAX_BYTES = 1048576
+VIEWER_OVERFLOW_POLICY = 'coalesce'
+
+# Lines of scrollback kept by the server side screen model (requires `pyte`), sent to joining viewers
+# together with the visible screen
+TERMINAL_SCROLLBACK_LINES = 1000
+# Threads parsing output into the screen models, off the event loop
+TERMINAL_SCREEN_WORKERS = 2
+
+# TRANSCRIPTS
+# Where flushed SSH output is stored:
+#  - 'terminal.transcripts.DatabaseTranscriptStore' (TranscriptChunk rows)
+#  - 'terminal.transcripts.FileTranscriptStore' (zlib compressed frames under TRANSCRIPT_DIR)
+TRANSCRIPT_STORE = 'terminal.transcripts.DatabaseTranscriptStore'
+TRANSCRIPT_DIR = BASE_DIR / 'transcripts'
+TRANSCRIPT_COMPRESSION_LEVEL = 6
+TRANSCRIPT_WORKERS = 2
+
+# Without the screen model only the last TERMINAL_INITIAL_SYNC_BYTES of the transcript are sent on join,
+# older output is fetched by the browser in pages of at most SCROLLBACK_PAGE_MAX_BYTES (the browser
+# asks for pages as large as what it already loaded, so replaying them stays linear in the history)
+TERMINAL_INITIAL_SYNC_BYTES = 65536
+SCROLLBACK_PAGE_MAX_BYTES = 1048576
+
+# Ring buffer of recent raw output allocated per live session: output waiting to be flushed to the
+# transcript (SSHData.BUFFER_SIZE_LIMIT) plus what viewers resuming a dropped WebSocket are replayed.
+# A resume missing more than TERMINAL_RESUME_MAX_BYTES gets a fresh snapshot instead
+OUTPUT_RING_BUFFER_BYTES = 262144
+TERMINAL_RESUME_MAX_BYTES = 1048576
+
+# Most results returned by the transcript and notes search endpoint
+SEARCH_RESULTS_MAX = 100
+# Seconds a note has to go without edits before it is indexed again
+SEARCH_NOTE_INDEX_DELAY = 2
+
+# Bearer token Prometheus sends to scrape `/metrics/` (each worker reports its own process), None disables the endpoint
+METRICS_TOKEN = None
+
+# Share of input batches traced from keystroke to echo (0 disables, 0.01 traces one in a hundred),
+# per stage latencies are served to staff at `/admin/latency/` and exported with the metrics
+LATENCY_TRACE_SAMPLE_RATE = 0.0
+
 # SERVER GLOBAL LIMIT
 
 MAX_SSH_SESSIONS = 100 # DZIAŁA
@@ -1,10 +1,11 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
-from terminal.views import handler403, handler404, handler500
+from terminal.views import handler403, handler404, handler500, LatencyView
 
 
 urlpatterns = [
+    path('admin/latency/', LatencyView.as_view(), name='admin.latency'),
     path('admin/', admin.site.urls),
     path('', include('terminal.urls')),
     path('403/', handler403, name='403'),